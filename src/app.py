@@ -1,31 +1,234 @@
+import base64
+import binascii
 import json
 from db import db
-from flask import Flask, request
+from db import set_sqlite_pragmas
+from flask import Blueprint, Flask, Response, current_app, g, request, send_from_directory, stream_with_context
 from db import User
 from db import Clothing
 from db import Outfit
 from db import Tag
 from db import Asset
+from db import association_table
+from images import InvalidImage
+import storage
+import assets_dao
 import users_dao
-import datetime
+import wardrobe_dao
+from list_cache import list_cache, make_etag
+from migrations import migrate
+import os
+import time
+import limits
+import metrics
+import serialization
+import suggestions
+from config import get_config
+from sqlalchemy import func, null
+from sqlalchemy.orm import selectinload
 
-app = Flask(__name__)
-db_filename = "ootd.db"
+api = Blueprint("api", __name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_filename}"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100))
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 200))
+SUGGESTION_COUNT = int(os.environ.get("SUGGESTION_COUNT", 10))
+MAX_SUGGESTION_COUNT = int(os.environ.get("MAX_SUGGESTION_COUNT", 50))
 
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+# routes guarded by each limiter in limits.py
+ROUTE_LIMITERS = {
+    "api.login": "password",
+    "api.register_account": "password",
+    "api.upload": "upload",
+    "api.upload_batch": "upload",
+    "api.import_wardrobe": "upload",
+}
+
+def create_app(config=None):
+    """
+    Creates the Flask app with the given configuration class, or the
+    profile named by APP_ENV
+
+    Does not touch the database schema; run "flask --app wsgi migrate"
+    (or python migrations.py) before serving a new or older database
+
+    Raises ValueError if the profile has no SECRET_KEY, as the
+    production profile does unless the environment sets one
+    """
+    app = Flask(__name__)
+    app.config.from_object(config or get_config())
+    if not app.config["SECRET_KEY"]:
+        raise ValueError("SECRET_KEY must be set to sign session tokens")
+
+    db.init_app(app)
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+        metrics.instrument_engine(db.engine)
+
+    app.register_blueprint(api)
+
+    @app.cli.command("migrate")
+    def migrate_command():
+        """
+        Creates or upgrades the database schema
+        """
+        migrate()
+
+    @app.cli.command("sweep")
+    def sweep_command():
+        """
+        Deletes every image queued for deletion from storage
+        """
+        while assets_dao.sweep_storage():
+            pass
+
+    return app
 
 # generalized response formats
+def json_response(body, code=200, headers=None):
+    """
+    Helper function that wraps an encoded JSON body in a response
+    """
+    return Response(body, code, headers, mimetype="application/json")
+
 def success_response(data, code=200):
-    return json.dumps(data), code
+    return json_response(serialization.dumps(data), code)
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response(serialization.dumps({"error": message}), code)
+
+def cached_list_response(user, params, build):
+    """
+    Helper function that returns a list response tagged with an ETag
+    derived from the user's data version
+
+    Answers 304 when the client already has this version, and otherwise
+    serves the serialized body from the list cache, calling build() to
+    produce the data only on a miss. Compressed bodies (see
+    compress_response) are cached alongside, one per content coding
+
+    The ETag is weak since it names the data rather than the bytes, which
+    differ by content coding
+    """
+    etag = make_etag(user, request.path, params)
+    headers = {"ETag": f'W/"{etag}"', "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    body = list_cache.get(etag)
+    if body is None:
+        body = serialization.dumps(build())
+        list_cache.put(etag, body)
+    encoding = serialization.negotiate(request.accept_encodings)
+    if encoding is None or len(body) < serialization.COMPRESS_MIN_BYTES:
+        return json_response(body, headers=headers)
+    compressed = list_cache.get(f"{etag}.{encoding}")
+    if compressed is None:
+        compressed = serialization.compress(body, encoding)
+        list_cache.put(f"{etag}.{encoding}", compressed)
+    headers["Content-Encoding"] = encoding
+    return json_response(compressed, headers=headers)
+
+# pagination methods
+def extract_page(params):
+    """
+    Helper function that extracts the cursor and page size of a list
+    request from its query string or body
+
+    The cursor is the opaque "next_cursor" of the previous page; returns
+    the id to continue after and the page size
+    """
+    limit = params.get("limit", PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return False, failure_response("Invalid limit", 400)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return False, failure_response(f"Limit must be between 1 and {MAX_PAGE_SIZE}", 400)
+    cursor = params.get("cursor")
+    if cursor is None:
+        return True, (0, limit)
+    try:
+        after_id = int(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (AttributeError, ValueError, binascii.Error):
+        return False, failure_response("Invalid cursor", 400)
+    return True, (after_id, limit)
+
+def paginate(query, model, page):
+    """
+    Helper function that returns one page of a query ordered by id,
+    seeking past the previous page instead of offsetting into it, and
+    the cursor of the next page or None when this is the last one
+    """
+    after_id, limit = page
+    rows = query.filter(model.id > after_id).order_by(model.id).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, base64.urlsafe_b64encode(str(rows[-1].id).encode("ascii")).decode("ascii")
+
+# list serialization, straight from query rows without loading ORM objects
+def link_query(size):
+    """
+    Helper function that returns a query for the clothing columns that
+    link_row serializes, joined to their assets; thumbnails are only read
+    when a size is asked for
+    """
+    variants = Asset.variants if size is not None else null()
+    return db.session.query(
+        Clothing.id, Clothing.classification, Asset.base_url, Asset.salt, Asset.extension, variants
+    ).join(Asset, Asset.id == Clothing.asset_id)
+
+def link_row(row, size):
+    """
+    Helper function that serializes a row of link_query with the link to
+    the image, or to its thumbnail for the given size
+    """
+    clothing_id, classification, base_url, salt, extension, variants = row
+    return {
+        "id": clothing_id,
+        "classification": classification,
+        "url": Asset.url_for(base_url, salt, extension, variants, size)
+    }
+
+def outfit_tags(outfit_ids):
+    """
+    Helper function that returns the serialized tags of the given outfits
+    by outfit id, in one query
+    """
+    tags = {}
+    if not outfit_ids:
+        return tags
+    rows = db.session.query(association_table.c.outfit_id, Tag.id, Tag.label).join(
+        Tag, Tag.id == association_table.c.tag_id
+    ).filter(association_table.c.outfit_id.in_(outfit_ids))
+    for outfit_id, tag_id, label in rows:
+        tags.setdefault(outfit_id, []).append({"id": tag_id, "label": label})
+    return tags
+
+def expand_outfits(outfits, size):
+    """
+    Helper function that serializes rows of (id, name, headwear_id, top_id,
+    bottom_id, shoes_id) with each piece of clothing linked and the tags,
+    in one query each for the clothing and the tags
+    """
+    clothing_ids = {clothing_id for outfit in outfits for clothing_id in outfit[2:] if clothing_id is not None}
+    links = {
+        row.id: link_row(row, size) for row in link_query(size).filter(Clothing.id.in_(clothing_ids))
+    } if clothing_ids else {}
+    tags = outfit_tags([outfit[0] for outfit in outfits])
+    return [
+        {
+            "id": outfit_id,
+            "name": name,
+            "headwear": links.get(headwear_id),
+            "top": links.get(top_id),
+            "bottom": links.get(bottom_id),
+            "shoes": links.get(shoes_id),
+            "tags": tags.get(outfit_id, [])
+        }
+        for outfit_id, name, headwear_id, top_id, bottom_id, shoes_id in outfits
+    ]
 
 # authentication method
 def extract_token(request):
@@ -40,8 +243,157 @@ def extract_token(request):
         return False, failure_response("Invalid auth header", 400)
     return True, bearer_token
 
+# request metrics
+@api.before_app_request
+def start_request_metrics():
+    """
+    Starts timing the request and collecting its SQL statements
+    """
+    g.request_start = time.perf_counter()
+    g.queries = []
+
+@api.before_app_request
+def limit_request_size():
+    """
+    Rejects bodies over MAX_CONTENT_LENGTH (MAX_IMPORT_BYTES for
+    wardrobe imports) before they are read; Flask only enforces the
+    limit itself when parsing form data
+    """
+    max_length = current_app.config["MAX_CONTENT_LENGTH"]
+    if request.endpoint == "api.import_wardrobe":
+        max_length = current_app.config["MAX_IMPORT_BYTES"]
+    if request.content_length is not None and request.content_length > max_length:
+        return failure_response(f"Request body is larger than {max_length} bytes", 413)
+
+# admission control
+def client_key(request):
+    """
+    Returns who a request counts against for rate limits: the user of a
+    valid session token, or else the client address
+    """
+    success, session_token = extract_token(request)
+    if success:
+        user_id = users_dao.get_user_id_by_session_token(session_token)
+        if user_id is not None:
+            return f"user:{user_id}"
+    return f"ip:{request.remote_addr}"
+
+@api.before_app_request
+def admit_request():
+    """
+    Applies the concurrency and rate limits of expensive routes, turning
+    requests away with a 503 or 429 before any work is done
+    """
+    name = ROUTE_LIMITERS.get(request.endpoint)
+    if name is None:
+        return
+    limiter = limits.LIMITERS[name]
+    rejection = limiter.admit(client_key(request))
+    if rejection is not None:
+        code, retry_after = rejection
+        message = "Too many requests" if code == 429 else "Server is busy"
+        response = failure_response(message, code)
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+    g.limiter = limiter
+
+@api.teardown_app_request
+def release_request(exc):
+    """
+    Frees the request's slot under its concurrency limit, even if the
+    request failed
+    """
+    limiter = g.pop("limiter", None)
+    if limiter is not None:
+        limiter.release()
+
+@api.app_errorhandler(413)
+def request_too_large(e):
+    """
+    Answers oversized multipart uploads in the API's error format
+    """
+    return failure_response(f"Request body is larger than {current_app.config['MAX_CONTENT_LENGTH']} bytes", 413)
+
+@api.after_app_request
+def record_request_metrics(response):
+    """
+    Records the latency and SQL statements of the request, logging a
+    breakdown of its queries when it took over SLOW_REQUEST_MS
+    """
+    if "request_start" not in g:
+        return response
+    duration = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    sql_duration = sum(query_duration for _, query_duration in g.queries)
+    metrics.REQUEST_LATENCY.observe(duration, route=route, method=request.method, status=response.status_code)
+    metrics.REQUEST_SQL_STATEMENTS.observe(len(g.queries), route=route)
+    metrics.SQL_STATEMENTS.inc(len(g.queries), route=route)
+    metrics.SQL_DURATION.inc(sql_duration, route=route)
+    if duration * 1000 >= SLOW_REQUEST_MS:
+        statements = {}
+        for statement, query_duration in g.queries:
+            count, total = statements.get(statement, (0, 0))
+            statements[statement] = (count + 1, total + query_duration)
+        slowest = sorted(statements.items(), key=lambda item: item[1][1], reverse=True)[:10]
+        current_app.logger.warning(json.dumps({
+            "event": "slow_request",
+            "route": route,
+            "method": request.method,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 2),
+            "sql_statements": len(g.queries),
+            "sql_ms": round(sql_duration * 1000, 2),
+            "queries": [
+                {"statement": statement, "count": count, "total_ms": round(total * 1000, 2)}
+                for statement, (count, total) in slowest
+            ]
+        }))
+    return response
+
+@api.after_app_request
+def compress_response(response):
+    """
+    Compresses JSON bodies of at least COMPRESS_MIN_BYTES with the
+    content coding the client prefers (see serialization.py); registered
+    after record_request_metrics so that its time is recorded too
+    """
+    if (
+        response.mimetype != "application/json"
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < serialization.COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = serialization.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(serialization.compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+@api.route("/metrics")
+def get_metrics():
+    """
+    Endpoint for scraping metrics in the Prometheus text format
+    """
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 # base endpoint
-@app.route("/")
+@api.route("/limits/")
+def get_limits():
+    """
+    Endpoint for monitoring admission control: the settings, requests in
+    flight and rejections of each limiter
+    """
+    return success_response(limits.state())
+
+@api.route("/")
 def hello_world():
     """
     Endpoint for printing Hello World!
@@ -49,7 +401,7 @@ def hello_world():
     return "Hello World!"
 
 # user routes
-@app.route("/register/", methods=["POST"])
+@api.route("/register/", methods=["POST"])
 def register_account():
     """
     Endpoint for registering a new user
@@ -74,7 +426,7 @@ def register_account():
         }
     )
 
-@app.route("/login/", methods=["POST"])
+@api.route("/login/", methods=["POST"])
 def login():
     """
     Endpoint for logging in a user
@@ -99,7 +451,7 @@ def login():
         }
     )
 
-@app.route("/logout/", methods=["POST"])
+@api.route("/logout/", methods=["POST"])
 def logout():
     """
     Endpoint for logging out a user
@@ -108,13 +460,12 @@ def logout():
     if not success:
         return session_token
     user = users_dao.get_user_by_session_token(session_token)
-    if user is None or not user.verify_session_token(session_token):
+    if user is None:
         return failure_response("Invalid session token", 400)
-    user.session_expiration = datetime.datetime.now()
-    db.session.commit()
+    users_dao.end_session(user)
     return success_response({"message": "User has successfully logged out"})
 
-@app.route("/session/", methods=["POST"])
+@api.route("/session/", methods=["POST"])
 def update_session():
     """
     Endpoint for updating a user's session
@@ -133,7 +484,7 @@ def update_session():
         }
     )
 
-@app.route("/secret/", methods=["POST"])
+@api.route("/secret/", methods=["POST"])
 def secret_message():
     """
     Endpoint for verifying a session token and returning a secret message
@@ -145,13 +496,13 @@ def secret_message():
 
     if not success:
         return session_token
-    user = users_dao.get_user_by_session_token(session_token)
-    if user is None or not user.verify_session_token(session_token):
+    user_id = users_dao.get_user_id_by_session_token(session_token)
+    if user_id is None:
         return failure_response("Invalid session token", 400)
     
     return success_response({"message": "Wow we implemented session token!!"})
 
-@app.route("/user/id/", methods=["POST"])
+@api.route("/user/id/", methods=["POST"])
 def get_user_id():
     """
     Endpoint for getting user_id by username
@@ -159,77 +510,289 @@ def get_user_id():
     body = json.loads(request.data)
     username = body.get("username")
     user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
     return success_response({"user_id": str(user.id)})
 
-@app.route("/user/list/")
+@api.route("/user/", methods=["DELETE"])
+def delete_account():
+    """
+    Endpoint for deleting the logged in user with all of their clothing,
+    outfits and images, in one transaction
+    """
+    success, session_token = extract_token(request)
+    if not success:
+        return session_token
+    user = users_dao.get_user_by_session_token(session_token)
+    if user is None:
+        return failure_response("Invalid session token", 400)
+    return success_response(users_dao.delete_user(user))
+
+@api.route("/user/export/")
+def export_wardrobe():
+    """
+    Endpoint for downloading the logged in user's assets, clothing and
+    outfits with their tags as NDJSON (see wardrobe_dao)
+
+    The export is streamed as it is read from the database, compressed
+    when the client accepts it; pass images=true to include every image,
+    for a complete backup
+    """
+    success, session_token = extract_token(request)
+    if not success:
+        return session_token
+    user = users_dao.get_user_by_session_token(session_token)
+    if user is None:
+        return failure_response("Invalid session token", 400)
+    include_images = request.args.get("images") == "true"
+    chunks = wardrobe_dao.export_wardrobe(user, include_images)
+    headers = {"Content-Disposition": 'attachment; filename="wardrobe.ndjson"', "Vary": "Accept-Encoding"}
+    encoding = serialization.negotiate(request.accept_encodings)
+    if encoding is not None:
+        chunks = serialization.compress_stream(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson", headers=headers)
+
+@api.route("/user/import/", methods=["POST"])
+def import_wardrobe():
+    """
+    Endpoint for importing an export from /user/export/ into the logged
+    in user's wardrobe, with the NDJSON as the request body
+
+    Rows are inserted in batches as the body is read; lines that cannot
+    be imported are skipped and reported
+    """
+    success, session_token = extract_token(request)
+    if not success:
+        return session_token
+    user = users_dao.get_user_by_session_token(session_token)
+    if user is None:
+        return failure_response("Invalid session token", 400)
+    success, result = wardrobe_dao.import_wardrobe(user, request.stream)
+    if not success:
+        return failure_response(result, 400)
+    return success_response(result)
+
+@api.route("/user/list/")
 def user_list():
     """
-    Endpoint for getting a list of all users
+    Endpoint for getting a page of users, see extract_page for the
+    "cursor" and "limit" query parameters
     """
-    return success_response({"user list": [user.serialize() for user in User.query.all()]})
+    success, page = extract_page(request.args)
+    if not success:
+        return page
+    users, next_cursor = paginate(db.session.query(User.id, User.username), User, page)
+    return success_response({
+        "user list": [{"id": user_id, "username": username} for user_id, username in users],
+        "next_cursor": next_cursor
+    })
 
 # clothing routes
 #   Create Clothing
 
-@app.route("/clothing/create/", methods=["POST"])
+@api.route("/clothing/create/", methods=["POST"])
 def upload():
     """
-    Endpoint for uploading an image to AWS given its base64 form,
-    adding the image to the clothing table, then returning the
-    serialized clothing object
+    Endpoint for uploading an image to AWS, adding the image to the
+    clothing table, then returning the serialized asset object
+
+    The image can be sent as:
+    - multipart/form-data with an "image" file part and "username" and
+      "classification" fields
+    - the raw image bytes with an image/* Content-Type and "username"
+      and "classification" in the query string
+    - JSON with the image as a base64 data URI in "image_data"
+    The binary forms skip the base64 and JSON copies of the image, and
+    large multipart parts are spooled to a temporary file while parsing
+
+    The image is checked from its header before anything is decoded or
+    stored: unsupported formats and corrupt headers get a 415, images
+    over MAX_IMAGE_BYTES or MAX_IMAGE_PIXELS a 413 (see images.py)
+
+    The upload itself runs in the background; poll /asset/<id>/
+    until its status is "ready". Uploading an image that is already
+    stored reuses the existing asset
     """
-    body = json.loads(request.data)
-    classification = body.get("classification")
-    username = body.get("username")
-    image_data = body.get("image_data")
-    if image_data is None:
-        return failure_response("No base64 image found")
-    asset = Asset(image_data=image_data)
-    db.session.add(asset)
-    db.session.commit()
+    if request.mimetype == "multipart/form-data":
+        fields = request.form
+        image_file = request.files.get("image")
+        if image_file is None:
+            return failure_response("No image file found")
+        image = {"image_file": image_file.stream}
+    elif request.mimetype.startswith("image/"):
+        fields = request.args
+        image = {"image_file": request.stream}
+    else:
+        fields = json.loads(request.data)
+        image_data = fields.get("image_data")
+        if image_data is None:
+            return failure_response("No base64 image found")
+        image = {"image_data": image_data}
+    classification = fields.get("classification")
+    username = fields.get("username")
+    if not isinstance(classification, str) or not classification:
+        return failure_response("Missing classification", 400)
     user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    try:
+        created, asset = assets_dao.create_asset(**image)
+    except InvalidImage as e:
+        return failure_response(str(e), e.code)
     clothing = Clothing(
         asset_id = asset.id,
         classification = classification,
         user_id = user.id
     )
     db.session.add(clothing)
+    users_dao.bump_data_version(user.id)
     db.session.commit()
+    asset.start_upload()
     return success_response(asset.serialize(), 201)
 
+def invalid_batch_item(item, field, missing):
+    """
+    Helper function that returns an error for a batch item that is not an
+    object or has no non-empty string in field, or None; items are checked
+    before anything is added so one bad item cannot fail the whole batch
+    """
+    if not isinstance(item, dict):
+        return "Invalid item"
+    value = item.get(field)
+    if not isinstance(value, str) or not value:
+        return missing
+    return None
+
+@api.route("/clothing/batch/", methods=["POST"])
+def upload_batch():
+    """
+    Endpoint for uploading many images at once given a list of
+    {"classification", "image_data"} items
+
+    The images are decoded in parallel and every item is added in one
+    transaction; returns the serialized asset or an error for each item,
+    with images checked as in /clothing/create/
+    """
+    body = json.loads(request.data)
+    username = body.get("username")
+    items = body.get("items")
+    if not isinstance(items, list) or not items:
+        return failure_response("No items found", 400)
+    if len(items) > MAX_BATCH_SIZE:
+        return failure_response(f"At most {MAX_BATCH_SIZE} items per batch", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    errors = [invalid_batch_item(item, "classification", "Missing classification") for item in items]
+    valid = [item for item, error in zip(items, errors) if error is None]
+    assets = iter(assets_dao.add_assets([item.get("image_data") or "" for item in valid]))
+    results = []
+    for item, error in zip(items, errors):
+        if error is not None:
+            results.append({"error": error})
+            continue
+        asset = next(assets)
+        if isinstance(asset, InvalidImage):
+            results.append({"error": str(asset)})
+            continue
+        db.session.add(Clothing(
+            asset_id = asset.id,
+            classification = item.get("classification"),
+            user_id = user.id
+        ))
+        results.append(asset)
+    users_dao.bump_data_version(user.id)
+    db.session.commit()
+    for asset in set(result for result in results if isinstance(result, Asset)):
+        asset.start_upload()
+    return success_response(
+        {"results": [result if isinstance(result, dict) else result.serialize() for result in results]},
+        201
+    )
+
+#   Serve images stored by the local storage backend
+
+@api.route("/assets/<path:key>")
+def get_local_asset(key):
+    """
+    Endpoint for serving images when STORAGE_BACKEND is "local"
+    """
+    if storage.STORAGE_BACKEND != "local":
+        return failure_response("Asset not found")
+    return send_from_directory(storage.LOCAL_STORAGE_DIR, key, max_age=31536000)
+
+#   Get upload status of an asset
+
+@api.route("/asset/<int:id>/")
+def get_asset(id):
+    """
+    Endpoint for polling the upload status of an asset by id
+    """
+    asset = Asset.query.filter_by(id=id).first()
+    if asset is None:
+        return failure_response("Asset not found")
+    return success_response(asset.serialize())
+
 #   Get Clothing list by user
 
-@app.route("/clothing/list/", methods=["POST"])
+@api.route("/clothing/list/", methods=["POST"])
 def get_clothing():
     """
-    Endpoint for getting a list of clothing by username
+    Endpoint for getting a page of clothing by username, see
+    extract_page for the "cursor" and "limit" fields
+
+    An optional "size" returns links to thumbnails at least that
+    many pixels on their longest side instead of the originals
     """
     body = json.loads(request.data)
     username = body.get("username")
-    assets = ""
+    size = body.get("size")
+    if size is not None and not isinstance(size, int):
+        return failure_response("Invalid size", 400)
+    success, page = extract_page(body)
+    if not success:
+        return page
     user = User.query.filter_by(username=username).first()
-    for clothing in Clothing.query.filter_by(user_id=user.id):
-        assets += clothing.get_link() + " "
-    return success_response({"assets": assets})
+    if user is None:
+        return failure_response("User not found")
 
-@app.route("/clothing/filter/", methods=["POST"])
+    def build():
+        query = link_query(size).filter(Clothing.user_id == user.id)
+        rows, next_cursor = paginate(query, Clothing, page)
+        return {"assets": [link_row(row, size) for row in rows], "next_cursor": next_cursor}
+
+    return cached_list_response(user, {"size": size, "page": page}, build)
+
+@api.route("/clothing/filter/", methods=["POST"])
 def filter_clothing():
     """
     Endpoint for getting a list of clothing by username 
-    filtered by classification
+    filtered by classification, with the same optional "size"
     """
     body = json.loads(request.data)
     username = body.get("username")
     classification = body.get("classification")
-    assets = ""
+    size = body.get("size")
+    if size is not None and not isinstance(size, int):
+        return failure_response("Invalid size", 400)
+    success, page = extract_page(body)
+    if not success:
+        return page
     user = User.query.filter_by(username=username).first()
-    for clothing in Clothing.query.filter_by(user_id=user.id, classification=classification):
-        assets += clothing.get_link() + " "
-    return success_response({"assets": assets})
+    if user is None:
+        return failure_response("User not found")
+
+    def build():
+        query = link_query(size).filter(Clothing.user_id == user.id, Clothing.classification == classification)
+        rows, next_cursor = paginate(query, Clothing, page)
+        return {"assets": [link_row(row, size) for row in rows], "next_cursor": next_cursor}
+
+    return cached_list_response(user, {"classification": classification, "size": size, "page": page}, build)
 
 #   Delete Clothing
 
-@app.route("/clothing/<int:id>/", methods=["DELETE"])
+@api.route("/clothing/<int:id>/", methods=["DELETE"])
 def delete_clothing(id):
     """
     Endpoint for deleting clothing by id
@@ -238,13 +801,44 @@ def delete_clothing(id):
     if clothing is None:
         return failure_response("Clothing not found")
     db.session.delete(clothing)
+    assets_dao.release_asset(clothing.asset)
+    users_dao.bump_data_version(clothing.user_id)
     db.session.commit()
     return success_response(clothing.serialize())
 
 # Outfit Routes
+OUTFIT_SLOTS = ["headwear_id", "top_id", "bottom_id", "shoes_id"]
+
+def owned_clothing_ids(user, outfits):
+    """
+    Helper function that returns which of the clothing ids in the slots
+    of the given outfits belong to user, in one query
+    """
+    ids = {fields.get(slot) for fields in outfits for slot in OUTFIT_SLOTS}
+    ids = {clothing_id for clothing_id in ids if isinstance(clothing_id, int)}
+    if not ids:
+        return set()
+    return {
+        clothing_id for (clothing_id,) in db.session.query(Clothing.id).filter(
+            Clothing.user_id == user.id, Clothing.id.in_(ids)
+        )
+    }
+
+def invalid_slot(fields, owned):
+    """
+    Helper function that returns an error for the first slot of an
+    outfit naming clothing that is not in owned, or None; the foreign
+    keys would otherwise fail the whole transaction
+    """
+    for slot in OUTFIT_SLOTS:
+        clothing_id = fields.get(slot)
+        if clothing_id is not None and (not isinstance(clothing_id, int) or clothing_id not in owned):
+            return f"Clothing not found for {slot}"
+    return None
+
 #   Create Outfit
 
-@app.route("/outfit/create/", methods=["POST"])
+@api.route("/outfit/create/", methods=["POST"])
 def create_outfit():
     """
     Endpoint for creating an outfit
@@ -257,6 +851,13 @@ def create_outfit():
     shoes_id = body.get("shoes_id")
     username = body.get("username")
     user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    if Outfit.query.filter_by(user_id=user.id, name=name).first() is not None:
+        return failure_response("Outfit already exists", 400)
+    error = invalid_slot(body, owned_clothing_ids(user, [body]))
+    if error is not None:
+        return failure_response(error, 400)
     outfit = Outfit(
         name = name,
         headwear_id = headwear_id,
@@ -266,59 +867,328 @@ def create_outfit():
         user_id = user.id
     )
     db.session.add(outfit)
+    users_dao.bump_data_version(user.id)
     db.session.commit()
     return success_response(outfit.serialize(), 201)
 
+@api.route("/outfit/batch/", methods=["POST"])
+def create_outfit_batch():
+    """
+    Endpoint for creating many outfits at once given a list of outfits
+    with the same fields as /outfit/create/
+
+    Every outfit is added in one transaction; returns the serialized
+    outfit or an error for each one
+    """
+    body = json.loads(request.data)
+    username = body.get("username")
+    outfits = body.get("outfits")
+    if not isinstance(outfits, list) or not outfits:
+        return failure_response("No outfits found", 400)
+    if len(outfits) > MAX_BATCH_SIZE:
+        return failure_response(f"At most {MAX_BATCH_SIZE} outfits per batch", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    errors = [invalid_batch_item(fields, "name", "Missing name") for fields in outfits]
+    valid = [fields for fields, error in zip(outfits, errors) if error is None]
+    taken = {
+        name for (name,) in db.session.query(Outfit.name).filter(
+            Outfit.user_id == user.id, Outfit.name.in_([fields.get("name") for fields in valid])
+        )
+    }
+    owned = owned_clothing_ids(user, valid)
+    results = []
+    for fields, error in zip(outfits, errors):
+        if error is not None:
+            results.append({"error": error})
+            continue
+        name = fields.get("name")
+        if name in taken:
+            results.append({"error": "Outfit already exists"})
+            continue
+        error = invalid_slot(fields, owned)
+        if error is not None:
+            results.append({"error": error})
+            continue
+        taken.add(name)
+        outfit = Outfit(
+            name = name,
+            headwear_id = fields.get("headwear_id"),
+            top_id = fields.get("top_id"),
+            bottom_id = fields.get("bottom_id"),
+            shoes_id = fields.get("shoes_id"),
+            user_id = user.id
+        )
+        db.session.add(outfit)
+        results.append(outfit)
+    users_dao.bump_data_version(user.id)
+    db.session.commit()
+    return success_response(
+        {"results": [result if isinstance(result, dict) else result.serialize() for result in results]},
+        201
+    )
+
 #   Get Outfit list by user
 
-@app.route("/outfit/list/", methods=["POST"])
+@api.route("/outfit/list/", methods=["POST"])
 def get_outfits():
     """
-    Endpoint for getting all outfits by username
+    Endpoint for getting a page of outfits by username, see
+    extract_page for the "cursor" and "limit" fields
+
+    With "expand": true, each outfit includes its clothing with links
+    to their images (or thumbnails, given "size") and its tags, loaded
+    in one query each whatever the page size
+
+    Answers 304 when If-None-Match matches the current ETag
     """
     body = json.loads(request.data)
     username = body.get("username")
+    expand = body.get("expand", False)
+    size = body.get("size")
+    if size is not None and not isinstance(size, int):
+        return failure_response("Invalid size", 400)
+    success, page = extract_page(body)
+    if not success:
+        return page
     user = User.query.filter_by(username=username).first()
-    outfits = [outfit.simple_serialize() for outfit in Outfit.query.filter_by(user_id=user.id)]
-    return success_response({"outfits": outfits})
+    if user is None:
+        return failure_response("User not found")
+
+    def build():
+        query = db.session.query(
+            Outfit.id, Outfit.name, Outfit.headwear_id, Outfit.top_id, Outfit.bottom_id, Outfit.shoes_id
+        ).filter(Outfit.user_id == user.id)
+        outfits, next_cursor = paginate(query, Outfit, page)
+        if not expand:
+            return {
+                "outfits": [
+                    {"name": name, "headwear_id": headwear_id, "top_id": top_id, "bottom_id": bottom_id, "shoes_id": shoes_id}
+                    for _, name, headwear_id, top_id, bottom_id, shoes_id in outfits
+                ],
+                "next_cursor": next_cursor
+            }
+        return {"outfits": expand_outfits(outfits, size), "next_cursor": next_cursor}
+
+    return cached_list_response(user, {"page": page, "expand": bool(expand), "size": size}, build)
+
+#   Search Outfits by tag
+
+@api.route("/outfit/search/", methods=["POST"])
+def search_outfits():
+    """
+    Endpoint for getting a page of a user's outfits tagged with any
+    ("match": "any", the default) or all ("match": "all") of "tags",
+    plus how many matching outfits carry each tag
+
+    Matching and facet counts are computed in SQL over the association
+    table's indexes; see extract_page for "cursor" and "limit"
+    """
+    body = json.loads(request.data)
+    username = body.get("username")
+    labels = body.get("tags")
+    match = body.get("match", "any")
+    if not isinstance(labels, list) or not labels:
+        return failure_response("No tags found", 400)
+    if not all(isinstance(label, str) for label in labels):
+        return failure_response("Tags must be strings", 400)
+    if match not in ("any", "all"):
+        return failure_response("Match must be any or all", 400)
+    success, page = extract_page(body)
+    if not success:
+        return page
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    labels = sorted(set(labels))
+
+    def build():
+        tag_ids = [tag_id for (tag_id,) in db.session.query(Tag.id).filter(Tag.label.in_(labels))]
+        if not tag_ids or (match == "all" and len(tag_ids) < len(labels)):
+            return {"outfits": [], "facets": {}, "next_cursor": None}
+        tagged = db.session.query(association_table.c.outfit_id).filter(
+            association_table.c.tag_id.in_(tag_ids)
+        )
+        if match == "all":
+            tagged = tagged.group_by(association_table.c.outfit_id).having(func.count() == len(tag_ids))
+        matching = db.session.query(Outfit.id).filter(Outfit.user_id == user.id, Outfit.id.in_(tagged))
+        facets = db.session.query(Tag.label, func.count()).join(
+            association_table, association_table.c.tag_id == Tag.id
+        ).filter(association_table.c.outfit_id.in_(matching)).group_by(Tag.id)
+        query = db.session.query(Outfit.id, Outfit.name).filter(Outfit.id.in_(matching))
+        outfits, next_cursor = paginate(query, Outfit, page)
+        tags = outfit_tags([outfit_id for outfit_id, _ in outfits])
+        return {
+            "outfits": [
+                {"id": outfit_id, "name": name, "tags": tags.get(outfit_id, [])} for outfit_id, name in outfits
+            ],
+            "facets": {label: count for label, count in facets},
+            "next_cursor": next_cursor
+        }
+
+    return cached_list_response(user, {"tags": labels, "match": match, "page": page}, build)
+
+#   Suggest Outfits
+
+@api.route("/outfit/suggest/", methods=["POST"])
+def suggest_outfits():
+    """
+    Endpoint for getting the "k" (default 10) best scoring outfits that
+    can be put together from a user's clothing, by color compatibility
+    of the pieces (see suggestions.py)
+
+    Each suggestion has its score and the clothing for each slot with
+    links to their images (or thumbnails, given "size")
+    """
+    body = json.loads(request.data)
+    username = body.get("username")
+    k = body.get("k", SUGGESTION_COUNT)
+    size = body.get("size")
+    if not isinstance(k, int) or not 0 < k <= MAX_SUGGESTION_COUNT:
+        return failure_response(f"k must be between 1 and {MAX_SUGGESTION_COUNT}", 400)
+    if size is not None and not isinstance(size, int):
+        return failure_response("Invalid size", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+
+    def build():
+        wardrobe = {}
+        rows = db.session.query(Clothing.id, Clothing.classification, Asset.palette).join(
+            Asset, Asset.id == Clothing.asset_id
+        ).filter(Clothing.user_id == user.id, Clothing.classification.in_(suggestions.SLOTS))
+        for clothing_id, classification, palette in rows:
+            wardrobe.setdefault(classification, []).append((clothing_id, palette))
+        suggested = suggestions.suggest(wardrobe, k)
+        clothing_ids = {clothing_id for _, outfit in suggested for clothing_id in outfit.values()}
+        links = {
+            row.id: link_row(row, size) for row in link_query(size).filter(Clothing.id.in_(clothing_ids))
+        } if clothing_ids else {}
+        return {"suggestions": [
+            {
+                "score": round(score, 4),
+                **{slot: links[clothing_id] for slot, clothing_id in outfit.items()}
+            }
+            for score, outfit in suggested
+        ]}
+
+    return cached_list_response(user, {"k": k, "size": size}, build)
 
 #   Delete Outfit
 
-@app.route("/outfit/delete/", methods=["DELETE"])
+@api.route("/outfit/delete/", methods=["DELETE"])
 def delete_outfit():
     """
-    Endpoint for deleting an outfit by name
+    Endpoint for deleting one of a user's outfits by name
     """
     body = json.loads(request.data)
     name = body.get("name")
-    outfit = Outfit.query.filter_by(name=name).first()
+    username = body.get("username")
+    if username is None:
+        return failure_response("Missing username", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    outfit = Outfit.query.filter_by(user_id=user.id, name=name).first()
     if outfit is None:
         return failure_response("Outfit not found")
     db.session.delete(outfit)
+    users_dao.bump_data_version(outfit.user_id)
     db.session.commit()
     return success_response(outfit.serialize())
 
 # Tag Routes
 #   Add tag
 
-@app.route("/tag/", methods=["POST"])
+@api.route("/tag/", methods=["POST"])
 def add_tag():
     """
-    Endpoint for creating and adding a tag to an outfit by outfit name
+    Endpoint for creating and adding a tag to one of a user's outfits by
+    outfit name
     """
     body = json.loads(request.data)
     label = body.get("label")
     outfit_name = body.get("outfit_name")
+    username = body.get("username")
+    if label is None:
+        return failure_response("Label not present", 400)
+    if username is None:
+        return failure_response("Missing username", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    outfit = Outfit.query.filter_by(user_id=user.id, name=outfit_name).first()
+    if outfit is None:
+        return failure_response("Outfit not found")
     tag = Tag.query.filter_by(label=label).first()
     if tag is None:
         tag = Tag(label=label)
         db.session.add(tag)
-    if label is None:
-        return failure_response("Lable not present", 400)
-    outfit = Outfit.query.filter_by(name=outfit_name).first()
-    outfit.tags.append(tag)
+    if tag not in outfit.tags:
+        outfit.tags.append(tag)
+        users_dao.bump_data_version(outfit.user_id)
     db.session.commit()
     return success_response(tag.serialize(), 201)
 
+@api.route("/tag/batch/", methods=["POST"])
+def add_tag_batch():
+    """
+    Endpoint for adding many tags at once given a list of
+    {"label", "outfit_name"} items for one user's outfits
+
+    Every tag is added in one transaction; returns the serialized tag
+    or an error for each item
+    """
+    body = json.loads(request.data)
+    username = body.get("username")
+    items = body.get("tags")
+    if not isinstance(items, list) or not items:
+        return failure_response("No tags found", 400)
+    if len(items) > MAX_BATCH_SIZE:
+        return failure_response(f"At most {MAX_BATCH_SIZE} tags per batch", 400)
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return failure_response("User not found")
+    errors = [invalid_batch_item(item, "label", "Label not present") for item in items]
+    valid = [item for item, error in zip(items, errors) if error is None]
+    labels = {item.get("label") for item in valid}
+    names = {item.get("outfit_name") for item in valid if isinstance(item.get("outfit_name"), str)}
+    tags = {tag.label: tag for tag in Tag.query.filter(Tag.label.in_(labels))}
+    outfits = {
+        outfit.name: outfit
+        for outfit in Outfit.query.options(selectinload(Outfit.tags)).filter(
+            Outfit.user_id == user.id, Outfit.name.in_(names)
+        )
+    }
+    results = []
+    for item, error in zip(items, errors):
+        if error is not None:
+            results.append({"error": error})
+            continue
+        label = item.get("label")
+        outfit_name = item.get("outfit_name")
+        outfit = outfits.get(outfit_name) if isinstance(outfit_name, str) else None
+        if outfit is None:
+            results.append({"error": "Outfit not found"})
+            continue
+        tag = tags.get(label)
+        if tag is None:
+            tag = tags[label] = Tag(label=label)
+            db.session.add(tag)
+        if tag not in outfit.tags:
+            outfit.tags.append(tag)
+        results.append(tag)
+    users_dao.bump_data_version(user.id)
+    db.session.commit()
+    return success_response(
+        {"results": [result if isinstance(result, dict) else result.serialize() for result in results]},
+        201
+    )
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        migrate()
+    assets_dao.start_sweeper(app)
+    app.run(host="0.0.0.0", port=8000, debug=app.config["DEBUG"])
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for accessing assets in our database
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+
+from db import db
+from db import Asset
+from db import Clothing
+from db import ASSET_FAILED
+from db import ASSET_PENDING
+from db import StorageTombstone
+from images import InvalidImage
+from storage import get_storage
+
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 4))
+decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+
+# deleted images are removed from storage by a background sweeper, in
+# batches of at most SWEEP_BATCH_SIZE keys (S3 allows 1000 per request)
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", 30))
+SWEEP_BATCH_SIZE = int(os.environ.get("SWEEP_BATCH_SIZE", 1000))
+
+
+def get_asset_by_content_hash(content_hash):
+    """
+    Returns an asset object from the database given the hash of its image
+    """
+    return Asset.query.filter(Asset.content_hash == content_hash).first()
+
+
+def create_asset(**kwargs):
+    """
+    Adds an Asset object to the session for an image, given either
+    image_data (a base64 data URI) or image_file and mime_type, or
+    references the existing asset when the same image was uploaded before
+
+    Does not commit, so the asset is only stored along with whatever
+    references it; returns if a new asset was created, and the Asset
+    object. Call start_upload on the asset after the commit. Raises
+    InvalidImage if the image is rejected
+    """
+    asset = Asset(**kwargs)
+    optional_asset = get_asset_by_content_hash(asset.content_hash)
+    if optional_asset is None:
+        asset.ref_count = 1
+        db.session.add(asset)
+        try:
+            db.session.flush()
+            return True, asset
+        except IntegrityError:
+            # the same image was committed by a concurrent request
+            db.session.rollback()
+            optional_asset = get_asset_by_content_hash(asset.content_hash)
+            if optional_asset is None:
+                raise
+
+    if optional_asset.status == ASSET_FAILED:
+        optional_asset.status = ASSET_PENDING
+        optional_asset._pending_img = asset._pending_img
+    optional_asset.ref_count = Asset.ref_count + 1
+    db.session.flush()
+    return False, optional_asset
+
+
+def _decode(image_data):
+    """
+    Returns the Asset for a base64 image, or the InvalidImage error it
+    was rejected with
+    """
+    try:
+        return Asset(image_data=image_data)
+    except InvalidImage as e:
+        return e
+
+
+def add_assets(image_datas):
+    """
+    Decodes base64 images in parallel and adds an Asset for each one to
+    the session, reusing stored assets (and earlier images in the same
+    batch) with the same content hash
+
+    Does not commit; returns a list with the Asset for each image, or the
+    InvalidImage error where the image was rejected. Call start_upload on
+    each asset after the commit
+    """
+    decoded = list(decode_executor.map(_decode, image_datas))
+    hashes = {asset.content_hash for asset in decoded if isinstance(asset, Asset)}
+    existing = {
+        asset.content_hash: asset
+        for asset in Asset.query.filter(Asset.content_hash.in_(hashes))
+    } if hashes else {}
+
+    assets = []
+    references = {}
+    for asset in decoded:
+        if isinstance(asset, InvalidImage):
+            assets.append(asset)
+            continue
+        optional_asset = existing.get(asset.content_hash)
+        if optional_asset is None:
+            db.session.add(asset)
+            existing[asset.content_hash] = optional_asset = asset
+        elif optional_asset.status == ASSET_FAILED:
+            optional_asset.status = ASSET_PENDING
+            optional_asset._pending_img = asset._pending_img
+        references[optional_asset] = references.get(optional_asset, 0) + 1
+        assets.append(optional_asset)
+
+    for asset, count in references.items():
+        if asset.id is None:
+            asset.ref_count = count
+        else:
+            asset.ref_count = Asset.ref_count + count
+    db.session.flush()
+    return assets
+
+
+def release_asset(asset):
+    """
+    Drops one reference to an asset, deleting it once nothing uses it
+    anymore and queueing its stored images for the sweeper
+
+    Does not commit
+    """
+    asset.ref_count = Asset.ref_count - 1
+    db.session.flush()
+    db.session.refresh(asset)
+    if asset.ref_count > 0:
+        return
+    db.session.delete(asset)
+    queue_storage_deletion(asset.get_keys())
+
+
+def release_user_assets(user_id):
+    """
+    Drops the references that a user's clothing holds on assets, ahead of
+    deleting all of that clothing, and queues the stored images of the
+    assets that nothing else uses
+
+    Does not commit; returns the ids of those assets, to delete once the
+    clothing is gone
+    """
+    owned = db.session.query(Clothing.asset_id).filter(Clothing.user_id == user_id)
+    references = db.session.query(func.count(Clothing.id)).filter(
+        Clothing.asset_id == Asset.id, Clothing.user_id == user_id
+    ).scalar_subquery()
+    db.session.query(Asset).filter(Asset.id.in_(owned)).update(
+        {"ref_count": Asset.ref_count - references}, synchronize_session=False
+    )
+    unused = Asset.query.filter(Asset.id.in_(owned), Asset.ref_count <= 0).all()
+    queue_storage_deletion([key for asset in unused for key in asset.get_keys()])
+    return [asset.id for asset in unused]
+
+
+def reference_assets(references):
+    """
+    Adds references to assets in bulk, given {asset_id: count}; negative
+    counts drop references
+
+    Does not commit
+    """
+    asset_ids = list(references)
+    for i in range(0, len(asset_ids), 500):
+        chunk = {asset_id: references[asset_id] for asset_id in asset_ids[i:i + 500]}
+        db.session.query(Asset).filter(Asset.id.in_(chunk)).update(
+            {"ref_count": Asset.ref_count + case(chunk, value=Asset.id, else_=0)}, synchronize_session=False
+        )
+
+
+def release_assets(references):
+    """
+    Drops references to assets in bulk, given {asset_id: count},
+    deleting the assets that nothing uses anymore and queueing their
+    stored images for the sweeper
+
+    Does not commit
+    """
+    reference_assets({asset_id: -count for asset_id, count in references.items()})
+    asset_ids = list(references)
+    for i in range(0, len(asset_ids), 500):
+        unused = Asset.query.filter(Asset.id.in_(asset_ids[i:i + 500]), Asset.ref_count <= 0).all()
+        queue_storage_deletion([key for asset in unused for key in asset.get_keys()])
+        Asset.query.filter(Asset.id.in_([asset.id for asset in unused])).delete(synchronize_session=False)
+
+
+def queue_storage_deletion(keys):
+    """
+    Adds a tombstone for each storage key, so that the images are only
+    deleted once the transaction that stopped using them commits
+
+    Does not commit
+    """
+    db.session.bulk_save_objects([StorageTombstone(key=key) for key in keys])
+
+
+def sweep_storage(batch_size=SWEEP_BATCH_SIZE):
+    """
+    Deletes up to batch_size tombstoned images from the storage backend
+    in one call, then their tombstones; keys the backend could not
+    delete keep their tombstone for the next sweep
+
+    Deleting is idempotent, so overlapping sweeps from several workers
+    only repeat work. Returns the number of tombstones cleared
+    """
+    tombstones = db.session.query(StorageTombstone.id, StorageTombstone.key).order_by(
+        StorageTombstone.id
+    ).limit(batch_size).all()
+    if not tombstones:
+        return 0
+    try:
+        failed = set(get_storage().delete([key for _, key in tombstones]))
+    except Exception as e:
+        print(f"Error when deleting images: {e}")
+        db.session.rollback()
+        return 0
+    done = [tombstone_id for tombstone_id, key in tombstones if key not in failed]
+    db.session.query(StorageTombstone).filter(StorageTombstone.id.in_(done)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(done)
+
+
+def _run_sweeper(app):
+    """
+    Sweeper thread: sweeps every SWEEP_INTERVAL seconds, with some
+    jitter so that workers drift apart, and keeps going while full
+    batches come back
+    """
+    while True:
+        time.sleep(SWEEP_INTERVAL * random.uniform(0.5, 1.5))
+        try:
+            with app.app_context():
+                while sweep_storage() == SWEEP_BATCH_SIZE:
+                    pass
+        except Exception as e:
+            print(f"Error when sweeping storage: {e}")
+
+
+def start_sweeper(app):
+    """
+    Starts the background thread that deletes tombstoned images, unless
+    SWEEP_INTERVAL is 0; call once per process, after any fork
+    """
+    if SWEEP_INTERVAL <= 0:
+        return
+    threading.Thread(target=_run_sweeper, args=(app,), name="sweeper", daemon=True).start()
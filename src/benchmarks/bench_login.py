@@ -0,0 +1,94 @@
+"""
+Login throughput benchmark
+
+Registers one user in a temporary database, then runs /login/ from
+several client threads, once with bcrypt on the request threads
+(PASSWORD_HASH_WORKERS=0) and once with the process pool. Each run
+happens in its own interpreter and prints one JSON line of results
+
+Usage: python benchmarks/bench_login.py [--threads 16] [--requests 200] [--rounds 12]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(threads, requests):
+    """
+    Runs the logins against the app configured by the environment
+    """
+    sys.path.insert(0, SRC_DIR)
+    from app import create_app
+    from db import db
+    from migrations import migrate
+    app = create_app()
+    with app.app_context():
+        db.engine.echo = False
+        migrate()
+
+    credentials = json.dumps({"username": "bench", "password": "hunter22"})
+    app.test_client().post("/register/", data=credentials)
+
+    def login(_):
+        start = time.perf_counter()
+        response = app.test_client().post("/login/", data=credentials)
+        assert response.status_code == 200, response.data
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(login, range(threads)))
+        start = time.perf_counter()
+        latencies = sorted(pool.map(login, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "hash_workers": os.environ["PASSWORD_HASH_WORKERS"],
+        "bcrypt_rounds": os.environ["BCRYPT_ROUNDS"],
+        "threads": threads,
+        "requests": requests,
+        "logins_per_second": round(requests / elapsed, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--workers", type=int, help="run a single configuration in this process")
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        run(args.threads, args.requests)
+        return
+
+    for workers in [0, os.cpu_count() or 1]:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{directory}/bench.db",
+                PASSWORD_HASH_WORKERS=str(workers),
+                BCRYPT_ROUNDS=str(args.rounds),
+                PASSWORD_ROUTE_CONCURRENCY="0",
+                PASSWORD_ROUTE_RATE="0"
+            )
+            subprocess.run(
+                [sys.executable, __file__, "--workers", str(workers),
+                 "--threads", str(args.threads), "--requests", str(args.requests)],
+                env=env,
+                check=True
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+List serialization and compression benchmark
+
+Seeds a temporary database (see seed.py) with one user owning --items
+pieces of clothing and --items outfits, then times:
+- building and encoding the whole wardrobe in-process, from ORM objects
+  with the standard library's json (how the list routes used to work)
+  against query rows with each encoder in serialization.ENCODERS
+- /clothing/list/ and /outfit/list/ with "expand" for the whole wardrobe
+  in one page, with each encoder and each content coding, reporting the
+  bytes sent
+The list cache is disabled so every call runs the queries. Prints one
+JSON line per scenario
+
+Usage: python benchmarks/bench_serialization.py [--items 1000] [--tags 20] [--repeat 20]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def median_ms(fn, repeat):
+    """
+    Returns the median time of fn in milliseconds, and its last result
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 2), result
+
+
+def run(args, directory):
+    """
+    Seeds the database in directory and times each scenario
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+    os.environ["LIST_CACHE_SIZE"] = "0"
+    os.environ["MAX_PAGE_SIZE"] = str(args.items)
+    sys.path.insert(0, SRC_DIR)
+    import app as app_module
+    import serialization
+    from db import db
+    from db import Clothing
+    from db import Outfit
+    from migrations import migrate
+    from sqlalchemy.orm import joinedload, selectinload
+    app = app_module.create_app()
+    with app.app_context():
+        db.engine.echo = False
+        migrate()
+    seed(f"{directory}/bench.db", 1, args.items, args.items, args.tags)
+
+    # the "before" baseline: how the list routes used to build their
+    # responses, from ORM objects loaded with their assets and tags
+    def orm_link(clothing):
+        return {"id": clothing.id, "classification": clothing.classification, "url": clothing.asset.get_url()}
+
+    def orm_clothing():
+        clothes = Clothing.query.options(joinedload(Clothing.asset)).filter_by(user_id=1).order_by(Clothing.id)
+        return {"assets": [orm_link(clothing) for clothing in clothes]}
+
+    def orm_outfits():
+        outfits = Outfit.query.options(selectinload(Outfit.tags)).filter_by(user_id=1).order_by(Outfit.id).all()
+        clothes = {clothing.id: clothing for clothing in Clothing.query.options(joinedload(Clothing.asset)).filter(
+            Clothing.id.in_({clothing_id for outfit in outfits for clothing_id in [
+                outfit.headwear_id, outfit.top_id, outfit.bottom_id, outfit.shoes_id
+            ] if clothing_id})
+        )}
+
+        def slot(clothing_id):
+            return orm_link(clothes[clothing_id]) if clothing_id else None
+        return {"outfits": [
+            {
+                "id": outfit.id,
+                "name": outfit.name,
+                "headwear": slot(outfit.headwear_id),
+                "top": slot(outfit.top_id),
+                "bottom": slot(outfit.bottom_id),
+                "shoes": slot(outfit.shoes_id),
+                "tags": [tag.serialize() for tag in outfit.tags]
+            }
+            for outfit in outfits
+        ]}
+
+    # what the list routes run now
+    def row_clothing():
+        rows = app_module.link_query(None).filter(Clothing.user_id == 1).order_by(Clothing.id)
+        return {"assets": [app_module.link_row(row, None) for row in rows]}
+
+    def row_outfits():
+        outfits = db.session.query(
+            Outfit.id, Outfit.name, Outfit.headwear_id, Outfit.top_id, Outfit.bottom_id, Outfit.shoes_id
+        ).filter(Outfit.user_id == 1).order_by(Outfit.id).all()
+        return {"outfits": app_module.expand_outfits(outfits, None)}
+
+    builds = [("clothing", orm_clothing, row_clothing), ("outfits expanded", orm_outfits, row_outfits)]
+    with app.app_context():
+        for name, orm_build, row_build in builds:
+            def orm():
+                db.session.remove()
+                return json.dumps(orm_build()).encode("utf8")
+            elapsed, body = median_ms(orm, args.repeat)
+            print(json.dumps({"scenario": f"build {name}", "method": "orm + json", "items": args.items,
+                              "median_ms": elapsed, "bytes": len(body)}))
+            for encoder_name, encode in serialization.ENCODERS.items():
+                def rows():
+                    db.session.remove()
+                    return encode(row_build())
+                elapsed, body = median_ms(rows, args.repeat)
+                print(json.dumps({"scenario": f"build {name}", "method": f"rows + {encoder_name}",
+                                  "items": args.items, "median_ms": elapsed, "bytes": len(body)}))
+
+    client = app.test_client()
+    routes = [
+        ("/clothing/list/", {"username": "user1", "limit": args.items}),
+        ("/outfit/list/", {"username": "user1", "limit": args.items, "expand": True}),
+    ]
+    for route, params in routes:
+        body = json.dumps(params)
+        for encoder_name, encode in serialization.ENCODERS.items():
+            serialization._encode = encode
+            for encoding in ["identity"] + serialization.encodings():
+                def call():
+                    response = client.post(route, data=body, headers={"Accept-Encoding": encoding})
+                    assert response.status_code == 200, response.data
+                    return response
+                elapsed, response = median_ms(call, args.repeat)
+                print(json.dumps({
+                    "scenario": route,
+                    "encoder": encoder_name,
+                    "encoding": response.headers.get("Content-Encoding", "identity"),
+                    "items": args.items,
+                    "median_ms": elapsed,
+                    "bytes": len(response.data)
+                }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        run(args, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Cold start benchmark
+
+Starts --runs fresh interpreters that import app and call create_app(),
+the work every new gunicorn master or container does before serving.
+Reports the median import and create times, which heavy dependencies
+were loaded by then, and the slowest imports made by app and create_app(), as measured by
+python -X importtime. Prints one JSON object
+
+Usage: python benchmarks/bench_startup.py [--runs 10] [--top 10]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["PIL.Image", "bcrypt", "boto3", "numpy"]
+
+CHILD = f"""
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "create_ms": (created - imported) * 1000,
+    "loaded": [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Returns the cumulative microseconds of each module imported directly
+    by app, or by create_app() afterwards, in python -X importtime output
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((depth, name.strip(), int(cumulative)))
+
+    app_index = next(i for i, (depth, name, _) in enumerate(entries) if depth == 0 and name == "app")
+    first = max((i + 1 for i, (depth, _, _) in enumerate(entries[:app_index]) if depth == 0), default=0)
+    return {
+        name: cumulative
+        for i, (depth, name, cumulative) in enumerate(entries)
+        if (first <= i < app_index and depth == 1) or (i > app_index and depth == 0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = []
+    imports = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(
+            os.environ,
+            APP_ENV="production",
+            SECRET_KEY="benchmark",
+            DATABASE_URL=f"sqlite:///{directory}/bench.db",
+            STORAGE_BACKEND="local",
+            LOCAL_STORAGE_DIR=f"{directory}/assets"
+        )
+        for _ in range(args.runs):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", CHILD],
+                cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True
+            )
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+            for name, cumulative in parse_importtime(result.stderr).items():
+                imports.setdefault(name, []).append(cumulative)
+
+    slowest = sorted(
+        ((name, statistics.median(values) / 1000) for name, values in imports.items()),
+        key=lambda item: item[1],
+        reverse=True
+    )[:args.top]
+    print(json.dumps({
+        "runs": args.runs,
+        "import_ms": round(statistics.median(run["import_ms"] for run in runs), 2),
+        "create_app_ms": round(statistics.median(run["create_ms"] for run in runs), 2),
+        "heavy_modules_loaded": runs[-1]["loaded"],
+        "slowest_imports_ms": {name: round(ms, 2) for name, ms in slowest}
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
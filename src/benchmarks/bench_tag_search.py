@@ -0,0 +1,81 @@
+"""
+Tag search benchmark
+
+Seeds a temporary database (see seed.py) with --outfits outfits spread
+over --users users, each outfit carrying three of --tags tag labels,
+then times /outfit/search/ for one user with "any" and "all" matching.
+The list cache is disabled so every call runs the queries. Prints one
+JSON line per scenario
+
+Usage: python benchmarks/bench_tag_search.py [--outfits 100000] [--users 10] [--tags 50]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(args, directory):
+    """
+    Seeds the database in directory and times each search scenario
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+    os.environ["LIST_CACHE_SIZE"] = "0"
+    sys.path.insert(0, SRC_DIR)
+    from app import create_app
+    from db import db
+    from migrations import migrate
+    app = create_app()
+    with app.app_context():
+        db.engine.echo = False
+        migrate()
+
+    seed(f"{directory}/bench.db", args.users, 0, args.outfits // args.users, args.tags)
+    client = app.test_client()
+
+    scenarios = [
+        ("any of 1", {"tags": ["tag1"], "match": "any"}),
+        ("any of 3", {"tags": ["tag1", "tag2", "tag3"], "match": "any"}),
+        ("all of 2", {"tags": ["tag1", "tag2"], "match": "all"}),
+        ("all of 3", {"tags": ["tag1", "tag2", "tag3"], "match": "all"}),
+    ]
+    for name, params in scenarios:
+        body = json.dumps(dict(params, username="user1", limit=50))
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            response = client.post("/outfit/search/", data=body)
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.data
+        result = json.loads(response.data)
+        print(json.dumps({
+            "scenario": name,
+            "outfits": args.outfits,
+            "page_size": len(result["outfits"]),
+            "first_tag_count": result["facets"].get(params["tags"][0], 0),
+            "median_ms": round(statistics.median(timings) * 1000, 2),
+            "max_ms": round(max(timings) * 1000, 2)
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--outfits", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        run(args, directory)
+
+
+if __name__ == "__main__":
+    main()
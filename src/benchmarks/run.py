@@ -0,0 +1,346 @@
+"""
+Benchmark and load-test suite
+
+Seeds a temporary SQLite database (see seed.py), stores images with the
+local storage backend, then runs:
+- micro-benchmarks of Asset.create, User.verify_password and list
+  serialization
+- every route in app.py from --concurrency client threads
+and reports throughput, p50/p95/p99 latency and SQL statements per
+request as JSON, to compare across commits
+
+Usage: python benchmarks/run.py [--users 50] [--clothing 40] [--outfits 20] [--tags 30]
+                                [--requests 200] [--concurrency 8] [--only PATTERN]
+                                [--output results.json]
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from seed import random_palette, seed
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_local = threading.local()
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at the given fraction of sorted values
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(name, kind, latencies, elapsed, queries):
+    """
+    Returns the result record of one benchmark
+    """
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "kind": kind,
+        "operations": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries_per_op": round(queries / len(latencies), 2)
+    }
+
+
+def image_uri(width, height, seed_value):
+    """
+    Returns a base64 data URI of a JPEG with some detail in it
+    """
+    from PIL import Image
+    img = Image.effect_noise((width, height), 40 + seed_value % 50).convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def count_queries(engine):
+    """
+    Counts SQL statements per thread, read through queries_so_far()
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(*args):
+        _local.queries = getattr(_local, "queries", 0) + 1
+
+
+def queries_so_far():
+    """
+    Returns the number of SQL statements run by this thread
+    """
+    return getattr(_local, "queries", 0)
+
+
+def micro(name, fn, repeat):
+    """
+    Runs fn(i) repeat times on this thread
+    """
+    fn(0)
+    latencies = []
+    queries = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        before = queries_so_far()
+        operation_start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - operation_start)
+        queries += queries_so_far() - before
+    return summarize(name, "micro", latencies, time.perf_counter() - start, queries)
+
+
+def load(app, name, request, count, concurrency):
+    """
+    Runs request(client, i) count times from concurrency threads, each
+    with its own test client; request returns the response
+    """
+    def call(i):
+        client = getattr(_local, "client", None)
+        if client is None:
+            client = _local.client = app.test_client()
+        before = queries_so_far()
+        start = time.perf_counter()
+        response = request(client, i)
+        latency = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f"{name} returned {response.status_code}: {response.data[:200]}")
+        return latency, queries_so_far() - before
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(call, range(count)))
+        elapsed = time.perf_counter() - start
+    return summarize(name, "route", [latency for latency, _ in results], elapsed, sum(q for _, q in results))
+
+
+def run(args, directory):
+    """
+    Seeds the database in directory and runs every benchmark
+    """
+    os.environ.update({
+        "APP_ENV": "production",
+        "SECRET_KEY": "benchmark",
+        "DATABASE_URL": f"sqlite:///{directory}/bench.db",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_DIR": f"{directory}/assets",
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+        "SLOW_REQUEST_MS": "1000000",
+        # measure the routes themselves, not admission control
+        "PASSWORD_ROUTE_CONCURRENCY": "0",
+        "PASSWORD_ROUTE_RATE": "0",
+        "UPLOAD_ROUTE_CONCURRENCY": "0",
+        "UPLOAD_ROUTE_RATE": "0",
+    })
+    sys.path.insert(0, SRC_DIR)
+    from app import create_app, expand_outfits, link_query, link_row
+    from db import db, Asset, Clothing, Outfit, User
+    from migrations import migrate
+    import passwords
+    import serialization
+    import suggestions
+
+    app = create_app()
+    with app.app_context():
+        count_queries(db.engine)
+        migrate()
+    seeded = seed(
+        f"{directory}/bench.db", args.users, args.clothing, args.outfits, args.tags,
+        password_digest=passwords.hash_password("password")
+    )
+    os.makedirs(f"{directory}/assets", exist_ok=True)
+    with open(f"{directory}/assets/bench.png", "wb") as f:
+        f.write(base64.b64decode(image_uri(64, 64, 0).split(",", 1)[1]))
+
+    uris = [image_uri(1024, 768, i) for i in range(8)]
+    images = [base64.b64decode(uri.split(",", 1)[1]) for uri in uris]
+    tokens = {}
+    with app.app_context():
+        for user in User.query.filter(User.id <= 3 * args.requests):
+            user.issue_tokens()
+            tokens[user.id] = (user.session_token, user.update_token)
+
+    def user_of(i):
+        return 1 + i % args.users
+
+    def body(**fields):
+        return json.dumps(fields)
+
+    def bearer(token):
+        return {"Authorization": f"Bearer {token}"}
+
+    def streamed(response):
+        # streamed bodies are only produced as they are read
+        response.get_data()
+        return response
+
+    export = streamed(app.test_client().get("/user/export/", headers=bearer(tokens[1][0]))).data
+
+    results = []
+    only = args.only
+
+    def wanted(name):
+        return only is None or only in name
+
+    # micro-benchmarks
+    micro_benchmarks = [
+        ("Asset.create 1024x768 jpeg", lambda: (lambda i: Asset(image_data=uris[i % len(uris)]))),
+        ("User.verify_password", lambda: (lambda user: (lambda i: user.verify_password("password")))(
+            User.query.filter_by(id=1).first()
+        )),
+        ("link_query + link_row x1000", lambda: (lambda i: serialization.dumps(
+            [link_row(row, None) for row in link_query(None).order_by(Clothing.id).limit(1000)]
+        ))),
+        ("expand_outfits x1000", lambda: (lambda i: serialization.dumps(expand_outfits(db.session.query(
+            Outfit.id, Outfit.name, Outfit.headwear_id, Outfit.top_id, Outfit.bottom_id, Outfit.shoes_id
+        ).order_by(Outfit.id).limit(1000).all(), None)))),
+        ("suggestions.suggest 4 slots x 300", lambda: (lambda wardrobe: (lambda i: suggestions.suggest(wardrobe, 10)))(
+            {slot: [(i, random_palette()) for i in range(300)] for slot in suggestions.SLOTS}
+        )),
+    ]
+    for name, make in micro_benchmarks:
+        if wanted(name):
+            with app.app_context():
+                results.append(micro(name, make(), args.micro_repeat))
+
+    # routes; writes run last so the reads see the seeded data, and they
+    # reuse seeded tag labels since concurrent creation of one new label
+    # conflicts on its unique index
+    n = args.requests
+    routes = [
+        ("GET /", lambda c, i: c.get("/")),
+        ("GET /metrics", lambda c, i: c.get("/metrics")),
+        ("GET /limits/", lambda c, i: c.get("/limits/")),
+        ("GET /user/list/", lambda c, i: c.get("/user/list/?limit=50")),
+        ("POST /user/id/", lambda c, i: c.post("/user/id/", data=body(username=f"user{user_of(i)}"))),
+        ("GET /user/export/", lambda c, i: streamed(
+            c.get("/user/export/", headers=bearer(tokens[1 + i % len(tokens)][0]))
+        )),
+        ("POST /secret/", lambda c, i: c.post("/secret/", headers=bearer(tokens[1 + i % len(tokens)][0]))),
+        ("GET /asset/<id>/", lambda c, i: c.get(f"/asset/{1 + i % (args.users * args.clothing)}/")),
+        ("GET /assets/<key>", lambda c, i: c.get("/assets/bench.png")),
+        ("POST /clothing/list/", lambda c, i: c.post("/clothing/list/", data=body(username=f"user{user_of(i)}"))),
+        ("POST /clothing/filter/", lambda c, i: c.post(
+            "/clothing/filter/", data=body(username=f"user{user_of(i)}", classification="top")
+        )),
+        ("POST /outfit/list/", lambda c, i: c.post("/outfit/list/", data=body(username=f"user{user_of(i)}"))),
+        ("POST /outfit/list/ expand", lambda c, i: c.post(
+            "/outfit/list/", data=body(username=f"user{user_of(i)}", expand=True)
+        )),
+        ("POST /outfit/search/", lambda c, i: c.post(
+            "/outfit/search/", data=body(username=f"user{user_of(i)}", tags=["tag1", "tag2"], match="any")
+        )),
+        ("POST /outfit/suggest/", lambda c, i: c.post("/outfit/suggest/", data=body(username=f"user{user_of(i)}"))),
+        ("POST /login/", lambda c, i: c.post("/login/", data=body(username=f"user{user_of(i)}", password="password"))),
+        ("POST /register/", lambda c, i: c.post("/register/", data=body(username=f"new{i}", password="password"))),
+        ("POST /clothing/create/", lambda c, i: c.post("/clothing/create/", data=body(
+            username=f"user{user_of(i)}", classification="top", image_data=uris[i % len(uris)]
+        ))),
+        ("POST /clothing/create/ multipart", lambda c, i: c.post("/clothing/create/", data={
+            "username": f"user{user_of(i)}", "classification": "top",
+            "image": (io.BytesIO(images[i % len(images)]), "image.jpg", "image/jpeg")
+        }, content_type="multipart/form-data")),
+        ("POST /clothing/batch/", lambda c, i: c.post("/clothing/batch/", data=body(
+            username=f"user{user_of(i)}",
+            items=[{"classification": "top", "image_data": uri} for uri in uris]
+        ))),
+        ("POST /outfit/create/", lambda c, i: c.post("/outfit/create/", data=body(
+            username=f"user{user_of(i)}", name=f"bench outfit {i}", top_id=(user_of(i) - 1) * args.clothing + 1
+        ))),
+        ("POST /outfit/batch/", lambda c, i: c.post("/outfit/batch/", data=body(
+            username=f"user{user_of(i)}", outfits=[{"name": f"bench batch {i}.{j}"} for j in range(10)]
+        ))),
+        ("POST /tag/", lambda c, i: c.post("/tag/", data=body(
+            username=f"user{1 + i // args.outfits}", label=f"tag{1 + i % args.tags}", outfit_name=f"outfit{1 + i}"
+        ))),
+        ("POST /tag/batch/", lambda c, i: c.post("/tag/batch/", data=body(
+            username=f"user{user_of(i)}",
+            tags=[{"label": f"tag{1 + j % args.tags}", "outfit_name": f"outfit{(user_of(i) - 1) * args.outfits + 1}"} for j in range(10)]
+        ))),
+        ("POST /user/import/", lambda c, i: c.post(
+            "/user/import/", data=export, headers=bearer(tokens[1 + i % len(tokens)][0])
+        )),
+        ("POST /session/", lambda c, i: c.post("/session/", headers=bearer(tokens[1 + i][1]))),
+        ("POST /logout/", lambda c, i: c.post("/logout/", headers=bearer(tokens[1 + len(tokens) // 3 + i][0]))),
+        ("DELETE /outfit/delete/", lambda c, i: c.delete("/outfit/delete/", data=body(
+            username=f"user{1 + i // args.outfits}", name=f"outfit{1 + i}"
+        ))),
+        ("DELETE /clothing/<id>/", lambda c, i: c.delete(f"/clothing/{1 + i}/")),
+        ("DELETE /user/", lambda c, i: c.delete("/user/", headers=bearer(tokens[1 + 2 * len(tokens) // 3 + i][0]))),
+    ]
+    for name, request in routes:
+        if not wanted(name):
+            continue
+        count = n
+        if name in ("POST /session/", "POST /logout/", "DELETE /user/"):
+            # each of these revokes the user's tokens, so they use each
+            # user once and split the users between them
+            count = min(n, len(tokens) // 3)
+        results.append(load(app, name, request, count, args.concurrency))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "seeded": seeded,
+            "requests": n,
+            "concurrency": args.concurrency,
+            "bcrypt_rounds": args.bcrypt_rounds
+        },
+        "results": results
+    }
+
+
+def _git_commit():
+    """
+    Returns the current git commit, or None outside a checkout
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--clothing", type=int, default=40, help="clothing items per user")
+    parser.add_argument("--outfits", type=int, default=20, help="outfits per user")
+    parser.add_argument("--tags", type=int, default=30)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--micro-repeat", type=int, default=50)
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = run(args, directory)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Bulk seeding of a benchmark database
+
+Inserts rows with executemany straight into a database whose schema was
+already created by the app, which is much faster than going through the
+routes. Every user's password is "password"
+"""
+
+import random
+import sqlite3
+
+CLASSIFICATIONS = ["headwear", "top", "bottom", "shoes"]
+
+
+def random_palette():
+    """
+    Returns a packed palette of four random colors whose weights add up
+    to about 255, as extracted by suggestions.extract_palette
+    """
+    weights = sorted((random.random() for _ in range(4)), reverse=True)
+    palette = bytearray()
+    for weight in weights:
+        palette += bytes(random.randrange(256) for _ in range(3))
+        palette.append(round(255 * weight / sum(weights)))
+    return bytes(palette)
+
+
+def seed(path, users, clothing, outfits, tags, tags_per_outfit=3, password_digest="x"):
+    """
+    Seeds users and, for each user, clothing items, outfits built from
+    them and tags on those outfits; clothing and outfits are per user
+
+    Returns the number of rows inserted per table
+    """
+    random.seed(0)
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO "user" (id, username, password_digest, token_version, data_version) VALUES (?, ?, ?, 0, 0)',
+        [(i, f"user{i}", password_digest) for i in range(1, users + 1)]
+    )
+    connection.executemany(
+        "INSERT INTO assets (id, base_url, salt, extension, width, height, created_at, status, content_hash, "
+        "ref_count, palette) "
+        "VALUES (?, 'http://localhost:8000/assets', ?, 'png', 1024, 768, '2023-05-01 00:00:00', 'ready', ?, 1, ?)",
+        [(i, f"SEED{i:012d}", f"seed{i}", random_palette()) for i in range(1, users * clothing + 1)]
+    )
+    connection.executemany(
+        "INSERT INTO clothing (id, asset_id, classification, user_id) VALUES (?, ?, ?, ?)",
+        [
+            (i, i, CLASSIFICATIONS[i % len(CLASSIFICATIONS)], 1 + (i - 1) // clothing)
+            for i in range(1, users * clothing + 1)
+        ]
+    )
+    connection.executemany(
+        "INSERT INTO tag (id, label) VALUES (?, ?)",
+        [(i, f"tag{i}") for i in range(1, tags + 1)]
+    )
+
+    outfit_rows = []
+    association_rows = []
+    for user_id in range(1, users + 1):
+        first = (user_id - 1) * clothing + 1
+        by_classification = {
+            classification: [
+                i for i in range(first, first + clothing)
+                if CLASSIFICATIONS[i % len(CLASSIFICATIONS)] == classification
+            ]
+            for classification in CLASSIFICATIONS
+        }
+        for _ in range(outfits):
+            outfit_id = len(outfit_rows) + 1
+            pieces = [
+                random.choice(by_classification[classification]) if by_classification[classification] else None
+                for classification in CLASSIFICATIONS
+            ]
+            outfit_rows.append((outfit_id, f"outfit{outfit_id}", *pieces, user_id))
+            for tag_id in random.sample(range(1, tags + 1), min(tags_per_outfit, tags)):
+                association_rows.append((outfit_id, tag_id))
+    connection.executemany(
+        "INSERT INTO outfit (id, name, headwear_id, top_id, bottom_id, shoes_id, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        outfit_rows
+    )
+    connection.executemany(
+        'INSERT INTO "association table" (outfit_id, tag_id) VALUES (?, ?)',
+        association_rows
+    )
+    connection.commit()
+    connection.close()
+    return {
+        "users": users,
+        "clothing": users * clothing,
+        "outfits": len(outfit_rows),
+        "tags": tags,
+        "outfit_tags": len(association_rows)
+    }
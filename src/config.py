@@ -0,0 +1,81 @@
+"""
+Configuration profiles
+
+APP_ENV picks the profile: "development" (default) runs the Flask dev
+server with debugging and SQL logging, "production" is tuned for serving
+behind gunicorn (see wsgi.py and gunicorn.conf.py)
+"""
+
+import os
+import secrets
+
+from sqlalchemy.pool import QueuePool
+
+
+class Config:
+    """
+    Settings shared by every profile
+    """
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///ootd.db")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # signs session tokens, so it must be the same on every worker and
+    # container and across restarts; create_app refuses to start without it
+    SECRET_KEY = os.environ.get("SECRET_KEY")
+    DEBUG = False
+    # largest request body accepted, in bytes; larger ones get a 413
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_REQUEST_BYTES", 32 * 1024 * 1024))
+    # wardrobe imports are streamed, and may carry every image
+    MAX_IMPORT_BYTES = int(os.environ.get("MAX_IMPORT_BYTES", 1024 * 1024 * 1024))
+
+    # applied to every new SQLite connection; SQLite only enforces
+    # foreign keys and their ON DELETE actions when asked to
+    SQLITE_PRAGMAS = {"foreign_keys": "ON"}
+
+
+class DevelopmentConfig(Config):
+    """
+    Flask dev server with debugging and every SQL statement logged
+    """
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    # without SECRET_KEY, sessions only last until the dev server restarts
+    SECRET_KEY = Config.SECRET_KEY or secrets.token_hex(32)
+
+
+class ProductionConfig(Config):
+    """
+    Multi-worker serving: WAL lets readers run alongside the writer,
+    synchronous=NORMAL skips an fsync per commit (safe under WAL), and
+    writers wait for the lock instead of failing with "database is locked"
+    """
+    SQLITE_PRAGMAS = {
+        **Config.SQLITE_PRAGMAS,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+        "cache_size": -16000,
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": QueuePool,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 8)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 8)),
+        "pool_timeout": 10,
+        "connect_args": {"check_same_thread": False},
+    }
+
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config():
+    """
+    Returns the configuration profile named by APP_ENV
+    """
+    app_env = os.environ.get("APP_ENV", "development")
+    if app_env not in PROFILES:
+        raise ValueError(f"Unknown APP_ENV {app_env}")
+    return PROFILES[app_env]
@@ -1,25 +1,60 @@
 from flask_sqlalchemy import SQLAlchemy
 import base64
-import boto3
+import binascii
 import datetime
-import io
 from io import BytesIO
-from mimetypes import guess_extension, guess_type
 import os
-from PIL import Image
 import random
 import re
 import string
 import hashlib
-import bcrypt
+import passwords
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from PIL import Image
+from sqlalchemy import event
+from metrics import IMAGE_DECODE_TIME
+from storage import get_storage
+import images
+from images import InvalidImage
+from suggestions import decode_palette, extract_palette
 
 db = SQLAlchemy()
 
+# PIL refuses to open anything larger, as a backstop to images.probe
+Image.MAX_IMAGE_PIXELS = images.MAX_IMAGE_PIXELS
+
+def set_sqlite_pragmas(engine, pragmas):
+    """
+    Runs PRAGMA statements on every new connection of a SQLite engine
+    """
+    if not pragmas or engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
 # image model and methods
-EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
+IMAGE_FORMATS = {"png": "PNG", "gif": "GIF", "jpg": "JPEG", "jpeg": "JPEG"}
+THUMBNAIL_SIZES = [1024, 512, 128]
+THUMBNAIL_QUALITY = 80
+DATA_URI_HEADER = re.compile(r"^data:(image/[\w.+-]+);base64$")
+
+# background upload pipeline
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+UPLOAD_QUEUE_SIZE = int(os.environ.get("UPLOAD_QUEUE_SIZE", 32))
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+upload_slots = threading.BoundedSemaphore(UPLOAD_QUEUE_SIZE)
+
+ASSET_PENDING = "pending"
+ASSET_READY = "ready"
+ASSET_FAILED = "failed"
 
 class Asset(db.Model):
     """
@@ -33,82 +68,307 @@ class Asset(db.Model):
     width = db.Column(db.Integer, nullable=False)
     height = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String, nullable=False, default=ASSET_PENDING)
+    variants = db.Column(db.JSON)
+    content_hash = db.Column(db.String, unique=True, index=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    palette = db.Column(db.LargeBinary)
     
     def __init__(self, **kwargs):
         """
-        Initializes an asset object
+        Initializes an asset object from either a base64 data URI
+        (image_data) or a binary file object (image_file)
+
+        Raises InvalidImage if the image is rejected
         """
-        self.create(kwargs.get("image_data"))
+        image_file = kwargs.get("image_file")
+        if image_file is not None:
+            self.create_from_file(image_file)
+        else:
+            self.create(kwargs.get("image_data"))
 
     def create(self, image_data):
         """
         Given an image in base64 encoding, does the following:
-        1. Rejects the image if it is not a supported filename
+        1. Rejects the image if it is not a supported format or too large
         2. Generate a random string for the image filename
-        3. Decodes the image and attempts to upload it to AWS
-        """
+        3. Decodes the image and keeps it until start_upload is called
+        """
+        if not isinstance(image_data, str):
+            raise InvalidImage("No base64 image found")
+        header, _, img_str = image_data.partition(",")
+        if DATA_URI_HEADER.match(header) is None:
+            raise InvalidImage("Image is not a base64 data URI")
+        if len(img_str) > images.max_encoded_length():
+            raise InvalidImage(f"Image is larger than {images.MAX_IMAGE_BYTES} bytes", 413)
         try:
-            ext = guess_extension(guess_type(image_data)[0])[1:]
-            if ext not in EXTENSIONS:
-                raise Exception(f"Extension {ext} is not valid!")
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits
-                )
-                for _ in range(16)
+            img_data = base64.b64decode(img_str, validate=True)
+        except binascii.Error:
+            raise InvalidImage("Image is not valid base64")
+        self.load(img_data)
+
+    def create_from_file(self, image_file):
+        """
+        Given a binary file object such as an uploaded multipart file,
+        reads at most MAX_IMAGE_BYTES of it and does the same as create
+        """
+        self.load(image_file.read(images.MAX_IMAGE_BYTES + 1))
+
+    def load(self, img_data):
+        """
+        Checks the image bytes with images.probe, then opens the image
+        and fills in the asset's columns
+        """
+        ext, width, height = images.probe(img_data)
+        salt = "".join(
+            random.SystemRandom().choice(
+                string.ascii_uppercase + string.digits
             )
-            img_str = re.sub("^data:image/.+;base64,", "", image_data)
-            img_data = base64.b64decode(img_str)
+            for _ in range(16)
+        )
+        try:
+            # only parses the header; the pixels are decoded in process
             img = Image.open(BytesIO(img_data))
-            
-            self.base_url = S3_BASE_URL
-            self.salt = salt
-            self.extension = ext
-            self.width = img.width
-            self.height = img.height
-            self.created_at = datetime.datetime.now()
-
-            img_filename = f"{self.salt}.{self.extension}"
-            
-            self.upload(img, img_filename)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise InvalidImage(f"Could not read image: {e}")
+
+        self.base_url = get_storage().base_url
+        self.salt = salt
+        self.extension = ext
+        self.width = width
+        self.height = height
+        self.created_at = datetime.datetime.now()
+        self.status = ASSET_PENDING
+        self.content_hash = hashlib.sha256(img_data).hexdigest()
+
+        self._pending_img = (img, img_data)
+
+    def start_upload(self):
+        """
+        Hands the decoded image to the upload workers; the asset must
+        already be committed so the worker can record the result.
+        If the upload queue is full the image is uploaded on the calling
+        thread instead, which pushes back on the client; either way the
+        result is recorded by _record_upload
+        """
+        pending = getattr(self, "_pending_img", None)
+        if pending is None:
+            return
+        self._pending_img = None
+        img, img_data = pending
+        app = current_app._get_current_object()
+        if upload_slots.acquire(blocking=False):
+            upload_executor.submit(_run_upload, app, self.id, img, img_data, self.salt, self.extension)
+        else:
+            values = Asset.process(img, img_data, self.salt, self.extension)
+            _record_upload(self.id, values, self.salt, self.extension)
+
+    @staticmethod
+    def process(img, img_data, salt, ext):
+        """
+        Decodes the image, then uploads it and its thumbnails and
+        extracts its palette
+
+        Returns the column values to record on the asset
+        """
+        try:
+            with IMAGE_DECODE_TIME.time():
+                img.load()
         except Exception as e:
-            print(f"Error when creating image: {e}")
+            print(f"Error when decoding image: {e}")
+            return {"status": ASSET_FAILED}
+        if not Asset.upload(img, img_data, f"{salt}.{ext}"):
+            return {"status": ASSET_FAILED}
+        values = {"status": ASSET_READY, "variants": Asset.upload_variants(img, salt)}
+        try:
+            values["palette"] = extract_palette(img)
+        except Exception as e:
+            print(f"Error when extracting palette: {e}")
+        return values
+
+    @staticmethod
+    def encode(img, img_data, ext):
+        """
+        Returns the bytes to store for an image with the given extension,
+        reusing the decoded bytes when they are already in that format
+        """
+        image_format = IMAGE_FORMATS[ext]
+        if img.format == image_format:
+            return img_data
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buffer = BytesIO()
+        img.save(buffer, format=image_format)
+        return buffer.getvalue()
 
-    def upload(self, img, img_filename):
+    @staticmethod
+    def upload(img, img_data, img_filename):
         """
-        Attempts to upload the image into the specified S3 bucket
+        Attempts to upload the image into the configured storage
+        backend straight from memory
+
+        Returns if the upload was successful
         """
         try:
-            #save image into temporary location
-            img_temp_location = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temp_location)
-            
-            #upload image into s3 bucket
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temp_location, S3_BUCKET_NAME, img_filename)
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL = "public-read")
-            
-            #remove image from temp location
-            os.remove(img_temp_location)
+            ext = img_filename.rsplit(".", 1)[1]
+            body = Asset.encode(img, img_data, ext)
+            get_storage().put(img_filename, body, Image.MIME[IMAGE_FORMATS[ext]])
+            return True
         except Exception as e:
             print(f"Error when uploading image: {e}")
+            return False
+
+    @staticmethod
+    def upload_variants(img, salt):
+        """
+        Uploads a WebP thumbnail for each size in THUMBNAIL_SIZES that is
+        smaller than the image, largest first so each one is resized from
+        the previous one
+
+        Returns the url and dimensions of each thumbnail keyed by size
+        """
+        variants = {}
+        try:
+            thumbnail = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+            for size in THUMBNAIL_SIZES:
+                if max(thumbnail.size) <= size:
+                    continue
+                thumbnail.thumbnail((size, size))
+                buffer = BytesIO()
+                thumbnail.save(buffer, format="WEBP", quality=THUMBNAIL_QUALITY)
+                img_filename = f"{salt}_{size}.webp"
+                storage = get_storage()
+                storage.put(img_filename, buffer.getvalue(), "image/webp")
+                variants[str(size)] = {
+                    "url": f"{storage.base_url}/{img_filename}",
+                    "width": thumbnail.width,
+                    "height": thumbnail.height
+                }
+        except Exception as e:
+            print(f"Error when uploading thumbnails: {e}")
+        return variants
+
+    def get_keys(self):
+        """
+        Returns the storage keys of the asset's image and thumbnails
+        """
+        keys = [f"{self.salt}.{self.extension}"]
+        keys += [f"{self.salt}_{size}.webp" for size in (self.variants or {})]
+        return keys
+
+    def get_url(self, size=None):
+        """
+        Returns the public url of the asset's image, or of its smallest
+        thumbnail that is at least size pixels on its longest side
+        """
+        return Asset.url_for(self.base_url, self.salt, self.extension, self.variants, size)
+
+    @staticmethod
+    def url_for(base_url, salt, extension, variants, size=None):
+        """
+        Returns the url get_url would from an asset's columns, for
+        serializing query rows without loading the asset
+        """
+        if size is not None and variants:
+            for variant_size in sorted(int(s) for s in variants):
+                if variant_size >= size:
+                    return variants[str(variant_size)]["url"]
+        return f"{base_url}/{salt}.{extension}"
 
     def serialize(self):
         """
         Serializes an asset object
         """
         return {
-            "url": f"{self.base_url}/{self.salt}.{self.extension}",
+            "id": self.id,
+            "url": self.get_url(),
+            "status": self.status,
+            "width": self.width,
+            "height": self.height,
+            "variants": self.variants or {},
+            "palette": decode_palette(self.palette),
             "created_at": str(self.created_at)
         }
 
 
+def _record_upload(asset_id, values, salt, ext):
+    """
+    Records the column values from Asset.process on an asset and commits,
+    bumping the data version of every user whose clothing uses it since
+    their thumbnail links changed. If the asset was deleted while
+    uploading, what was just stored is queued for the sweeper instead
+    """
+    if not Asset.query.filter_by(id=asset_id).update(values):
+        keys = [f"{salt}.{ext}"] + [f"{salt}_{size}.webp" for size in values.get("variants") or {}]
+        db.session.add_all([StorageTombstone(key=key) for key in keys])
+    owners = db.session.query(Clothing.user_id).filter(Clothing.asset_id == asset_id)
+    User.query.filter(User.id.in_(owners.scalar_subquery())).update(
+        {"data_version": User.data_version + 1}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def _run_upload(app, asset_id, img, img_data, salt, ext):
+    """
+    Upload worker: uploads the image and its thumbnails, then records
+    whether the asset is ready or failed
+    """
+    try:
+        values = Asset.process(img, img_data, salt, ext)
+        with app.app_context():
+            _record_upload(asset_id, values, salt, ext)
+    except Exception as e:
+        print(f"Error when recording upload of asset {asset_id}: {e}")
+    finally:
+        upload_slots.release()
+
+
+class StorageTombstone(db.Model):
+    """
+    Storage key of a deleted asset's image or thumbnail, waiting for the
+    sweeper to delete it from the storage backend (see assets_dao)
+    """
+    __tablename__ = "storage_tombstone"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    key = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a tombstone for a storage key
+        """
+        self.key = kwargs.get("key")
+        self.created_at = datetime.datetime.now()
+
+
+# session tokens
+SESSION_TOKEN = "session"
+UPDATE_TOKEN = "update"
+SESSION_LENGTH = datetime.timedelta(days=1)
+
+def _token_serializer(kind):
+    """
+    Returns the serializer that signs tokens of the given kind
+    """
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt=kind)
+
+def load_token(token, kind):
+    """
+    Returns the payload of a signed token of the given kind, or None if
+    the signature is invalid or the session token has expired
+    """
+    max_age = SESSION_LENGTH.total_seconds() if kind == SESSION_TOKEN else None
+    try:
+        return _token_serializer(kind).loads(token, max_age=max_age)
+    except BadSignature:
+        return None
+
+
 association_table = db.Table(
     "association table",
-    db.Column("outfit_id", db.Integer, db.ForeignKey("outfit.id")),
-    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"))
+    db.Column("outfit_id", db.Integer, db.ForeignKey("outfit.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id", ondelete="CASCADE"), primary_key=True),
+    db.Index("ix_association_tag_id_outfit_id", "tag_id", "outfit_id")
 )
 
 class User(db.Model):
@@ -123,52 +383,63 @@ class User(db.Model):
     password_digest = db.Column(db.String, nullable=False)
     
     # Session information
-    session_token = db.Column(db.String, nullable=False, unique=True)
-    session_expiration = db.Column(db.DateTime, nullable=False)
-    update_token = db.Column(db.String, nullable=False, unique=True)
+    # Session and update tokens are signed and carry the user id and the
+    # token version they were issued for; bumping the version revokes them
+    token_version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Bumped by every change to the user's clothing, outfits and tags;
+    # list responses use it as their ETag
+    data_version = db.Column(db.Integer, nullable=False, default=0)
 
     def __init__(self, **kwargs):
         """
         Initializes a user object
         """
         self.username = kwargs.get("username")
-        self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
-        self.renew_session()
+        self.password_digest = passwords.hash_password(kwargs.get("password"))
+        self.token_version = 0
+        self.data_version = 0
 
-    def _urlsafe_base_64(self):
+    def renew_session(self):
         """
-        Randomly generates hashed tokens (used for session/update tokens)
+        Renews the sessions, i.e.
+        1. Revokes every session and update token issued so far
+        2. Issues a new session token and update token
         """
-        return hashlib.sha1(os.urandom(64)).hexdigest()
+        self.token_version += 1
+        self.issue_tokens()
 
-    def renew_session(self):
+    def issue_tokens(self):
         """
-        Renews the sessions, i.e.
-        1. Creates a new session token
-        2. Sets the expiration time of the session to be a day from now
-        3. Creates a new update token
+        Issues a session token that expires a day from now and an update
+        token, both for the current token version
+
+        The user must already be committed so that its id is known
         """
-        self.session_token = self._urlsafe_base_64()
-        self.session_expiration = datetime.datetime.now() + datetime.timedelta(days=1)
-        self.update_token = self._urlsafe_base_64()
+        payload = {"user_id": self.id, "version": self.token_version}
+        self.session_token = _token_serializer(SESSION_TOKEN).dumps(payload)
+        self.session_expiration = datetime.datetime.now() + SESSION_LENGTH
+        self.update_token = _token_serializer(UPDATE_TOKEN).dumps(payload)
 
     def verify_password(self, password):
         """
         Verifies the password of a user
         """
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        return passwords.check_password(password, self.password_digest)
 
     def verify_session_token(self, session_token):
         """
         Verifies the session token of a user
         """
-        return session_token == self.session_token and datetime.datetime.now() < self.session_expiration
+        payload = load_token(session_token, SESSION_TOKEN)
+        return payload == {"user_id": self.id, "version": self.token_version}
 
     def verify_update_token(self, update_token):
         """
         Verifies the update token of a user
         """
-        return update_token == self.update_token
+        payload = load_token(update_token, UPDATE_TOKEN)
+        return payload == {"user_id": self.id, "version": self.token_version}
     
     def serialize(self):
         """
@@ -184,10 +455,14 @@ class Clothing(db.Model):
     Clothing model
     """
     __tablename__ = "clothing"
+    __table_args__ = (
+        db.Index("ix_clothing_user_id_classification", "user_id", "classification"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    asset_id = db.Column(db.Integer, nullable=False)
+    asset_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False, index=True)
     classification = db.Column(db.String, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    asset = db.relationship("Asset")
 
     def __init__(self, **kwargs):
         """
@@ -207,28 +482,26 @@ class Clothing(db.Model):
             "classification": self.classification,
             "user_id": self.user_id
         }
-    
-    def get_link(self):
-        """
-        Serializes a clothing object with all clothing ids
-        and links to images
-        """
-        asset = Asset.query.filter_by(id=self.asset_id).first()
-        return f"{asset.base_url}/{asset.salt}.{asset.extension}"
-    
+
 class Outfit(db.Model):
     """
     Outfit model
     """
     __tablename__ = "outfit"
+    __table_args__ = (
+        db.Index("ix_outfit_user_id_name", "user_id", "name", unique=True),
+    )
+    # deleting a piece of clothing empties its slot in every outfit, and
+    # deleting a user deletes their outfits; see the foreign_keys pragma
+    # in config.py
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String, nullable=False)
-    headwear_id = db.Column(db.Integer, db.ForeignKey("clothing.id"))
-    top_id = db.Column(db.Integer, db.ForeignKey("clothing.id"))
-    bottom_id = db.Column(db.Integer, db.ForeignKey("clothing.id"))
-    shoes_id = db.Column(db.Integer, db.ForeignKey("clothing.id"))
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    tags = db.relationship("Tag", secondary=association_table)
+    name = db.Column(db.String, nullable=False, index=True)
+    headwear_id = db.Column(db.Integer, db.ForeignKey("clothing.id", ondelete="SET NULL"), index=True)
+    top_id = db.Column(db.Integer, db.ForeignKey("clothing.id", ondelete="SET NULL"), index=True)
+    bottom_id = db.Column(db.Integer, db.ForeignKey("clothing.id", ondelete="SET NULL"), index=True)
+    shoes_id = db.Column(db.Integer, db.ForeignKey("clothing.id", ondelete="SET NULL"), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    tags = db.relationship("Tag", secondary=association_table, back_populates="outfits")
 
     def __init__(self, **kwargs):
         """
@@ -251,19 +524,6 @@ class Outfit(db.Model):
             "name": self.name,
             "tags": tag_list
         }
-    
-    def simple_serialize(self):
-        """
-        Serializes an outfit object with the ids of
-        each piece of clothing in the outfit
-        """
-        return {
-            "name": self.name,
-            "headwear_id": self.headwear_id,
-            "top_id": self.top_id,
-            "bottom_id": self.bottom_id,
-            "shoes_id": self.shoes_id
-        }
 
 class Tag(db.Model):
     """
@@ -271,8 +531,8 @@ class Tag(db.Model):
     """
     __tablename__ = "tag"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    label = db.Column(db.String, nullable=False)
-    outfits = db.relationship("Outfit", secondary=association_table)
+    label = db.Column(db.String, nullable=False, unique=True, index=True)
+    outfits = db.relationship("Outfit", secondary=association_table, back_populates="tags")
 
     def __init__(self, **kwargs):
         """
@@ -0,0 +1,32 @@
+"""
+gunicorn settings for the production profile
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# lets the app size its per-worker pools (see passwords.py) before it is
+# preloaded
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+timeout = 30
+keepalive = 5
+# import the app once in the master before forking
+preload_app = True
+raw_env = ["APP_ENV=production"]
+
+
+def post_fork(server, worker):
+    """
+    Drops database connections inherited from the master so that each
+    worker opens its own, and starts the worker's storage sweeper
+    """
+    from wsgi import app
+    from db import db
+    import assets_dao
+    with app.app_context():
+        db.engine.dispose()
+    assets_dao.start_sweeper(app)
@@ -0,0 +1,103 @@
+"""
+Validation of uploaded images
+
+probe() works out an image's real format from its magic bytes and its
+size from its header alone, then enforces MAX_IMAGE_BYTES and
+MAX_IMAGE_PIXELS, so that nothing is decoded or stored for images that
+are not supported or too large
+"""
+
+import os
+import struct
+
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 16 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 50_000_000))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+GIF_SIGNATURES = (b"GIF87a", b"GIF89a")
+
+# JPEG start of frame markers, which carry the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class InvalidImage(Exception):
+    """
+    An uploaded image that was rejected, with the HTTP status to answer
+    """
+
+    def __init__(self, message, code=400):
+        """
+        Initializes the error with its message and status code
+        """
+        super().__init__(message)
+        self.code = code
+
+
+def _jpeg_size(img_data):
+    """
+    Returns the width and height in a JPEG's start of frame segment
+    """
+    offset = 2
+    while offset + 4 <= len(img_data):
+        if img_data[offset] != 0xFF:
+            raise InvalidImage("Corrupt JPEG header", 415)
+        marker = img_data[offset + 1]
+        if marker == 0xFF:
+            # fill byte before a marker
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a segment
+            offset += 2
+            continue
+        (length,) = struct.unpack(">H", img_data[offset + 2:offset + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(img_data):
+                break
+            height, width = struct.unpack(">HH", img_data[offset + 5:offset + 9])
+            return width, height
+        if marker == 0xDA or length < 2:
+            break
+        offset += 2 + length
+    raise InvalidImage("Corrupt JPEG header", 415)
+
+
+def probe(img_data):
+    """
+    Returns the extension, width and height of an image from its bytes,
+    reading only its header
+
+    Raises InvalidImage for unsupported formats and corrupt headers (415)
+    and images over MAX_IMAGE_BYTES or MAX_IMAGE_PIXELS (413)
+    """
+    if len(img_data) > MAX_IMAGE_BYTES:
+        raise InvalidImage(f"Image is larger than {MAX_IMAGE_BYTES} bytes", 413)
+    if img_data.startswith(PNG_SIGNATURE):
+        if len(img_data) < 24 or img_data[12:16] != b"IHDR":
+            raise InvalidImage("Corrupt PNG header", 415)
+        ext = "png"
+        width, height = struct.unpack(">II", img_data[16:24])
+    elif img_data.startswith(JPEG_SIGNATURE):
+        ext = "jpg"
+        width, height = _jpeg_size(img_data)
+    elif img_data[:6] in GIF_SIGNATURES:
+        if len(img_data) < 10:
+            raise InvalidImage("Corrupt GIF header", 415)
+        ext = "gif"
+        width, height = struct.unpack("<HH", img_data[6:10])
+    else:
+        raise InvalidImage("Image must be a PNG, JPEG or GIF", 415)
+    if width == 0 or height == 0:
+        raise InvalidImage("Image has no pixels")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise InvalidImage(f"Image has more than {MAX_IMAGE_PIXELS} pixels", 413)
+    return ext, width, height
+
+
+def max_encoded_length():
+    """
+    Returns the longest base64 string that can decode to an image within
+    MAX_IMAGE_BYTES
+    """
+    return 4 * -(-MAX_IMAGE_BYTES // 3)
@@ -0,0 +1,278 @@
+"""
+Admission control for expensive routes
+
+Each limiter guards a group of routes with two checks, made before the
+request is handled:
+- a concurrency limit: at most CONCURRENCY requests of the group run at
+  once in each worker process, and further ones get a 503
+- a rate limit: a token bucket per client (the user of a valid session
+  token, or else the client address) holding BURST requests and refilled
+  at RATE requests per minute; requests finding it empty get a 429
+Both answer with Retry-After. A limit of 0 turns that check off.
+
+Each gunicorn worker serves WEB_THREADS requests at once; by default a
+group may use all but one of them, so that each group on its own always
+leaves a thread to the cheap routes, and uploads get half. Token buckets
+are kept in memory per process unless RATE_LIMIT_STORE is "sqlite",
+which shares them between the workers of a host through the SQLite file
+RATE_LIMIT_DB
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_REJECTED
+
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "ootd-rate-limits.db"))
+# buckets kept by the memory store; the least recently used are dropped
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100_000))
+# seconds a client turned away by a concurrency limit is asked to wait
+BUSY_RETRY_AFTER = int(os.environ.get("BUSY_RETRY_AFTER", 1))
+# request threads per gunicorn worker, see gunicorn.conf.py
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 4))
+
+
+def _refill(tokens, updated, now, rate, burst):
+    """
+    Returns the tokens in a bucket after refilling it since updated and
+    taking one if there is one, and 0 if one was taken or else the
+    seconds until there is one
+    """
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """
+    Token buckets held in this process, at most max_keys of them
+    """
+
+    def __init__(self, max_keys):
+        """
+        Initializes a store with no buckets
+        """
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket for key, which holds up to burst
+        tokens and refills at rate tokens per second
+
+        Returns 0 if a token was taken, or else the seconds until the
+        next one
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens, wait = _refill(tokens, updated, now, rate, burst)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def size(self):
+        """
+        Returns the number of buckets held
+        """
+        return len(self.buckets)
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a SQLite file shared by every worker of a host, with
+    one connection per thread and one short write transaction per take;
+    buckets are dropped once they have refilled, since a missing bucket
+    counts as full
+    """
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, path):
+        """
+        Initializes the store; the file is opened on first use
+        """
+        self.path = path
+        self.local = threading.local()
+        self.last_prune = 0
+
+    def _connect(self):
+        """
+        Returns this thread's connection, creating the table on first use
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            # losing recent buckets in a crash only resets some limits
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)"
+            )
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket for key, like MemoryBucketStore.take
+        """
+        connection = self._connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens, wait = _refill(tokens, updated, now, rate, burst)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (burst - tokens) / rate)
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if now - self.last_prune > self.PRUNE_INTERVAL:
+            self.last_prune = now
+            connection.execute("DELETE FROM buckets WHERE full_at < ?", (now,))
+        return wait
+
+    def size(self):
+        """
+        Returns the number of buckets held
+        """
+        return self._connect().execute("SELECT count(*) FROM buckets").fetchone()[0]
+
+
+class RouteLimiter:
+    """
+    Concurrency and rate limits shared by a group of routes
+    """
+
+    def __init__(self, name, concurrency, rate, burst, store):
+        """
+        Initializes the limiter with concurrency requests in flight per
+        process and rate requests per minute per client, in bursts of up
+        to burst
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+        self.in_flight = 0
+        self.rejected = {"concurrency": 0, "rate": 0}
+        self.lock = threading.Lock()
+
+    def _reject(self, reason):
+        """
+        Counts a request turned away for the given reason
+        """
+        with self.lock:
+            self.rejected[reason] += 1
+        ADMISSION_REJECTED.inc(limiter=self.name, reason=reason)
+
+    def _take(self, client):
+        """
+        Returns the seconds the client must wait under the rate limit, 0
+        if the request may go ahead; lets requests through if the store
+        fails
+        """
+        if self.rate <= 0:
+            return 0
+        try:
+            return self.store.take(f"{self.name}:{client}", self.rate / 60, max(self.burst, 1))
+        except Exception as e:
+            print(f"Error when checking rate limit {self.name}: {e}")
+            return 0
+
+    def admit(self, client):
+        """
+        Returns None if a request from client may run, in which case call
+        release once it ends, or else the status code to answer with (503
+        or 429) and the seconds to wait before retrying
+        """
+        with self.lock:
+            if 0 < self.concurrency <= self.in_flight:
+                busy = True
+            else:
+                busy = False
+                self.in_flight += 1
+        if busy:
+            self._reject("concurrency")
+            return 503, BUSY_RETRY_AFTER
+        ADMISSION_IN_FLIGHT.inc(limiter=self.name)
+        wait = self._take(client)
+        if wait:
+            self.release()
+            self._reject("rate")
+            return 429, math.ceil(wait)
+        return None
+
+    def release(self):
+        """
+        Marks a request admitted by admit as finished
+        """
+        with self.lock:
+            self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.dec(limiter=self.name)
+
+    def state(self):
+        """
+        Returns the limiter's settings, requests in flight and rejections
+        """
+        with self.lock:
+            return {
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "rate_per_minute": self.rate,
+                "burst": self.burst,
+                "rejected": dict(self.rejected)
+            }
+
+
+if RATE_LIMIT_STORE == "memory":
+    bucket_store = MemoryBucketStore(RATE_LIMIT_MAX_KEYS)
+elif RATE_LIMIT_STORE == "sqlite":
+    bucket_store = SQLiteBucketStore(RATE_LIMIT_DB)
+else:
+    raise ValueError(f"Unknown rate limit store {RATE_LIMIT_STORE}")
+
+LIMITERS = {
+    # bcrypt hashing on /login/ and /register/
+    "password": RouteLimiter(
+        "password",
+        int(os.environ.get("PASSWORD_ROUTE_CONCURRENCY", max(WEB_THREADS - 1, 1))),
+        int(os.environ.get("PASSWORD_ROUTE_RATE", 20)),
+        int(os.environ.get("PASSWORD_ROUTE_BURST", 10)),
+        bucket_store
+    ),
+    # image decoding and storage uploads
+    "upload": RouteLimiter(
+        "upload",
+        int(os.environ.get("UPLOAD_ROUTE_CONCURRENCY", max(WEB_THREADS // 2, 1))),
+        int(os.environ.get("UPLOAD_ROUTE_RATE", 120)),
+        int(os.environ.get("UPLOAD_ROUTE_BURST", 30)),
+        bucket_store
+    ),
+}
+
+
+def state():
+    """
+    Returns the state of every limiter, for monitoring
+    """
+    return {
+        "store": RATE_LIMIT_STORE,
+        "buckets": bucket_store.size(),
+        "limiters": {name: limiter.state() for name, limiter in LIMITERS.items()}
+    }
@@ -0,0 +1,61 @@
+"""
+In-process cache of serialized list responses
+
+Entries are keyed on the user's data version, so a create or delete that
+bumps the version makes every older entry for that user unreachable;
+stale entries simply age out of the LRU
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+LIST_CACHE_SIZE = int(os.environ.get("LIST_CACHE_SIZE", 1024))
+
+
+class ListCache:
+    """
+    Thread-safe LRU mapping of ETags to serialized response bodies
+    """
+
+    def __init__(self, max_size):
+        """
+        Initializes an empty cache holding at most max_size bodies
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached body for a key, or None
+        """
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        """
+        Caches a body, evicting the least recently used one when full
+        """
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+list_cache = ListCache(LIST_CACHE_SIZE)
+
+
+def make_etag(user, route, params):
+    """
+    Returns the ETag of a list response: the user, their data version and
+    a digest of the route and request parameters
+    """
+    digest = hashlib.sha1(json.dumps([route, params], sort_keys=True).encode("utf8")).hexdigest()[:16]
+    return f"{user.id}-{user.data_version}-{digest}"
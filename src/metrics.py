@@ -0,0 +1,215 @@
+"""
+In-process metrics in the Prometheus text format
+
+Every gunicorn worker keeps its own values, so each scrape of /metrics
+reports the worker that served it
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200]
+
+
+def _format_labels(names, values, extra=None):
+    """
+    Returns the {name="value",...} part of a sample
+    """
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing value per label set
+    """
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Initializes a counter with no samples
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Adds amount to the value for the given labels
+        """
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        """
+        Returns the counter in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Value per label set that can go up and down
+    """
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Initializes a gauge with no samples
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Adds amount to the value for the given labels
+        """
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """
+        Subtracts amount from the value for the given labels
+        """
+        self.inc(-amount, **labels)
+
+    def render(self):
+        """
+        Returns the gauge in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values per label set
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Initializes a histogram with no observations
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Records one observation for the given labels
+        """
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            counts, total, observations = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [count + (value <= bound) for count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, observations + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the body of a with block takes
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """
+        Returns the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, observations) in sorted(self.values.items()):
+                for count, bound in zip(counts, self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', bound))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {observations}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {observations}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request", ("route", "method", "status")
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "http_request_sql_statements", "SQL statements run per request", ("route",), QUERY_COUNT_BUCKETS
+)
+SQL_STATEMENTS = Counter("sql_statements_total", "SQL statements run", ("route",))
+SQL_DURATION = Counter("sql_duration_seconds_total", "Time spent running SQL statements", ("route",))
+IMAGE_DECODE_TIME = Histogram("image_decode_seconds", "Time spent decoding an uploaded image")
+STORAGE_UPLOAD_TIME = Histogram("storage_upload_seconds", "Time spent storing one image or thumbnail", ("backend",))
+BCRYPT_TIME = Histogram("bcrypt_seconds", "Time spent hashing or checking a password", ("operation",))
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Requests running under a concurrency limit", ("limiter",))
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Requests turned away by a concurrency or rate limit", ("limiter", "reason")
+)
+
+REGISTRY = [
+    REQUEST_LATENCY,
+    REQUEST_SQL_STATEMENTS,
+    SQL_STATEMENTS,
+    SQL_DURATION,
+    IMAGE_DECODE_TIME,
+    STORAGE_UPLOAD_TIME,
+    BCRYPT_TIME,
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_REJECTED,
+]
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument_engine(engine):
+    """
+    Times every SQL statement run by an engine; statements run while
+    handling a request are recorded on flask.g.queries for the request
+    hooks, others are counted under the "background" route
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+        if has_request_context() and "queries" in g:
+            g.queries.append((statement, duration))
+        else:
+            SQL_STATEMENTS.inc(route="background")
+            SQL_DURATION.inc(duration, route="background")
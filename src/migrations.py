@@ -0,0 +1,219 @@
+"""
+Versioned schema migrations
+
+The schema version is kept in SQLite's user_version pragma. A new
+database is created from the models and stamped with the latest version;
+an existing one has every newer migration applied in order
+
+Run before serving a new or upgraded database, with
+"flask --app wsgi migrate" or: python migrations.py
+"""
+
+from db import db
+
+# Each migration brings the schema from the previous version to its own;
+# version 0 is the schema that db.create_all() built before migrations
+MIGRATIONS = [
+    (
+        1,
+        "asset upload status, thumbnails and content hash",
+        [
+            "ALTER TABLE assets ADD COLUMN status VARCHAR NOT NULL DEFAULT 'ready'",
+            "ALTER TABLE assets ADD COLUMN variants JSON",
+            "ALTER TABLE assets ADD COLUMN content_hash VARCHAR",
+            "ALTER TABLE assets ADD COLUMN ref_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE assets SET ref_count = (SELECT COUNT(*) FROM clothing WHERE clothing.asset_id = assets.id)",
+            "CREATE UNIQUE INDEX ix_assets_content_hash ON assets (content_hash)",
+        ]
+    ),
+    (
+        2,
+        "signed session tokens",
+        [
+            """CREATE TABLE user_new (
+                id INTEGER NOT NULL,
+                username VARCHAR NOT NULL,
+                password_digest VARCHAR NOT NULL,
+                token_version INTEGER NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (username)
+            )""",
+            "INSERT INTO user_new (id, username, password_digest, token_version) "
+            "SELECT id, username, password_digest, 0 FROM \"user\"",
+            "DROP TABLE \"user\"",
+            "ALTER TABLE user_new RENAME TO \"user\"",
+        ]
+    ),
+    (
+        3,
+        "indexes and constraints for the app's queries",
+        [
+            "CREATE INDEX ix_clothing_user_id_classification ON clothing (user_id, classification)",
+            # keep the first outfit with each name, renaming later duplicates
+            "UPDATE outfit SET name = name || ' (' || id || ')' WHERE id NOT IN "
+            "(SELECT MIN(id) FROM outfit GROUP BY user_id, name)",
+            "CREATE UNIQUE INDEX ix_outfit_user_id_name ON outfit (user_id, name)",
+            "CREATE INDEX ix_outfit_name ON outfit (name)",
+            # merge tags with the same label into the first one
+            "UPDATE \"association table\" SET tag_id = "
+            "(SELECT MIN(t.id) FROM tag t WHERE t.label = "
+            "(SELECT label FROM tag WHERE tag.id = \"association table\".tag_id))",
+            "DELETE FROM tag WHERE id NOT IN (SELECT MIN(id) FROM tag GROUP BY label)",
+            "CREATE UNIQUE INDEX ix_tag_label ON tag (label)",
+            """CREATE TABLE association_new (
+                outfit_id INTEGER NOT NULL,
+                tag_id INTEGER NOT NULL,
+                PRIMARY KEY (outfit_id, tag_id),
+                FOREIGN KEY(outfit_id) REFERENCES outfit (id),
+                FOREIGN KEY(tag_id) REFERENCES tag (id)
+            )""",
+            "INSERT OR IGNORE INTO association_new (outfit_id, tag_id) "
+            "SELECT outfit_id, tag_id FROM \"association table\" "
+            "WHERE outfit_id IS NOT NULL AND tag_id IS NOT NULL",
+            "DROP TABLE \"association table\"",
+            "ALTER TABLE association_new RENAME TO \"association table\"",
+            "CREATE INDEX ix_association_tag_id_outfit_id ON \"association table\" (tag_id, outfit_id)",
+        ]
+    ),
+    (
+        4,
+        "per-user data version for list ETags",
+        [
+            "ALTER TABLE \"user\" ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0",
+        ]
+    ),
+    (
+        5,
+        "user_id indexes ordered by id for keyset pagination",
+        [
+            "CREATE INDEX ix_clothing_user_id ON clothing (user_id)",
+            "CREATE INDEX ix_outfit_user_id ON outfit (user_id)",
+        ]
+    ),
+    (
+        6,
+        "asset color palettes for outfit suggestions",
+        [
+            "ALTER TABLE assets ADD COLUMN palette BLOB",
+        ]
+    ),
+    (
+        7,
+        "ON DELETE actions and indexes on foreign keys, storage tombstones",
+        [
+            # clear references left behind by earlier deletes
+            "UPDATE outfit SET headwear_id = NULL WHERE headwear_id NOT IN (SELECT id FROM clothing)",
+            "UPDATE outfit SET top_id = NULL WHERE top_id NOT IN (SELECT id FROM clothing)",
+            "UPDATE outfit SET bottom_id = NULL WHERE bottom_id NOT IN (SELECT id FROM clothing)",
+            "UPDATE outfit SET shoes_id = NULL WHERE shoes_id NOT IN (SELECT id FROM clothing)",
+            "DELETE FROM \"association table\" WHERE outfit_id NOT IN (SELECT id FROM outfit) "
+            "OR tag_id NOT IN (SELECT id FROM tag)",
+            """CREATE TABLE clothing_new (
+                id INTEGER NOT NULL,
+                asset_id INTEGER NOT NULL,
+                classification VARCHAR NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(asset_id) REFERENCES assets (id),
+                FOREIGN KEY(user_id) REFERENCES user (id) ON DELETE CASCADE
+            )""",
+            "INSERT INTO clothing_new SELECT id, asset_id, classification, user_id FROM clothing",
+            "DROP TABLE clothing",
+            "ALTER TABLE clothing_new RENAME TO clothing",
+            "CREATE INDEX ix_clothing_user_id_classification ON clothing (user_id, classification)",
+            "CREATE INDEX ix_clothing_user_id ON clothing (user_id)",
+            "CREATE INDEX ix_clothing_asset_id ON clothing (asset_id)",
+            """CREATE TABLE outfit_new (
+                id INTEGER NOT NULL,
+                name VARCHAR NOT NULL,
+                headwear_id INTEGER,
+                top_id INTEGER,
+                bottom_id INTEGER,
+                shoes_id INTEGER,
+                user_id INTEGER,
+                PRIMARY KEY (id),
+                FOREIGN KEY(headwear_id) REFERENCES clothing (id) ON DELETE SET NULL,
+                FOREIGN KEY(top_id) REFERENCES clothing (id) ON DELETE SET NULL,
+                FOREIGN KEY(bottom_id) REFERENCES clothing (id) ON DELETE SET NULL,
+                FOREIGN KEY(shoes_id) REFERENCES clothing (id) ON DELETE SET NULL,
+                FOREIGN KEY(user_id) REFERENCES user (id) ON DELETE CASCADE
+            )""",
+            "INSERT INTO outfit_new SELECT id, name, headwear_id, top_id, bottom_id, shoes_id, user_id FROM outfit",
+            "DROP TABLE outfit",
+            "ALTER TABLE outfit_new RENAME TO outfit",
+            "CREATE UNIQUE INDEX ix_outfit_user_id_name ON outfit (user_id, name)",
+            "CREATE INDEX ix_outfit_name ON outfit (name)",
+            "CREATE INDEX ix_outfit_user_id ON outfit (user_id)",
+            "CREATE INDEX ix_outfit_headwear_id ON outfit (headwear_id)",
+            "CREATE INDEX ix_outfit_top_id ON outfit (top_id)",
+            "CREATE INDEX ix_outfit_bottom_id ON outfit (bottom_id)",
+            "CREATE INDEX ix_outfit_shoes_id ON outfit (shoes_id)",
+            """CREATE TABLE association_new (
+                outfit_id INTEGER NOT NULL,
+                tag_id INTEGER NOT NULL,
+                PRIMARY KEY (outfit_id, tag_id),
+                FOREIGN KEY(outfit_id) REFERENCES outfit (id) ON DELETE CASCADE,
+                FOREIGN KEY(tag_id) REFERENCES tag (id) ON DELETE CASCADE
+            )""",
+            "INSERT INTO association_new SELECT outfit_id, tag_id FROM \"association table\"",
+            "DROP TABLE \"association table\"",
+            "ALTER TABLE association_new RENAME TO \"association table\"",
+            "CREATE INDEX ix_association_tag_id_outfit_id ON \"association table\" (tag_id, outfit_id)",
+            """CREATE TABLE storage_tombstone (
+                id INTEGER NOT NULL,
+                "key" VARCHAR NOT NULL,
+                created_at DATETIME NOT NULL,
+                PRIMARY KEY (id)
+            )""",
+        ]
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(connection):
+    """
+    Returns the schema version of the database
+    """
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate():
+    """
+    Creates or upgrades the database schema to LATEST_VERSION
+
+    Must be called inside an app context. Foreign keys are not enforced
+    while migrating, so that tables they point at can be rebuilt
+    """
+    with db.engine.begin() as connection:
+        tables = db.inspect(connection).get_table_names()
+        version = get_version(connection)
+        if not tables:
+            db.metadata.create_all(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {LATEST_VERSION}")
+            return
+    if version >= LATEST_VERSION:
+        return
+
+    with db.engine.connect() as connection:
+        foreign_keys = connection.exec_driver_sql("PRAGMA foreign_keys").scalar()
+        connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+        try:
+            for migration_version, description, statements in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                print(f"Migrating database to version {migration_version}: {description}")
+                with connection.begin():
+                    for statement in statements:
+                        connection.exec_driver_sql(statement)
+                    connection.exec_driver_sql(f"PRAGMA user_version = {migration_version}")
+        finally:
+            connection.exec_driver_sql(f"PRAGMA foreign_keys = {foreign_keys}")
+
+
+if __name__ == "__main__":
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        migrate()
@@ -0,0 +1,99 @@
+"""
+Password hashing helpers
+
+bcrypt runs in a dedicated process pool so that hashing does not hold up
+request threads, with at most PASSWORD_HASH_QUEUE_SIZE hashes in flight.
+Set PASSWORD_HASH_WORKERS=0 to hash on the calling thread instead.
+bcrypt itself is imported on first use, keeping it out of app startup
+
+bcrypt releases the GIL, so request threads already hash in parallel;
+the pool only adds throughput on hosts with more cores than gunicorn
+workers. Every worker starts its own pool, so by default each gets the
+cores left per worker (WEB_CONCURRENCY, set by gunicorn.conf.py), and
+at least one process
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import BCRYPT_TIME
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 13))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+PASSWORD_HASH_WORKERS = int(os.environ.get(
+    "PASSWORD_HASH_WORKERS", max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1)
+))
+PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 4 * max(PASSWORD_HASH_WORKERS, 1)))
+
+_executor = None
+_executor_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_SIZE)
+
+
+def _hashpw(password, rounds):
+    """
+    Hashes a password with the given bcrypt cost
+    """
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _checkpw(password, digest):
+    """
+    Checks a password against a bcrypt digest
+    """
+    import bcrypt
+    return bcrypt.checkpw(password, digest)
+
+
+def _get_executor():
+    """
+    Returns the process pool, starting it on first use; workers are
+    started through a fork server so they never inherit request threads
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=PASSWORD_HASH_WORKERS,
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+    return _executor
+
+
+def _run(fn, *args):
+    """
+    Runs fn in the process pool and waits for its result
+    """
+    if PASSWORD_HASH_WORKERS == 0:
+        return fn(*args)
+    with _hash_slots:
+        return _get_executor().submit(fn, *args).result()
+
+
+def hash_password(password):
+    """
+    Returns the bcrypt digest of a password using BCRYPT_ROUNDS
+    """
+    with BCRYPT_TIME.time(operation="hash"):
+        return _run(_hashpw, password.encode("utf8"), BCRYPT_ROUNDS)
+
+
+def check_password(password, digest):
+    """
+    Returns if the password matches the bcrypt digest
+    """
+    if isinstance(digest, str):
+        digest = digest.encode("utf8")
+    with BCRYPT_TIME.time(operation="check"):
+        return _run(_checkpw, password.encode("utf8"), digest)
+
+
+def needs_rehash(digest):
+    """
+    Returns if the digest was made with a different cost than BCRYPT_ROUNDS
+    """
+    return int(digest[4:6]) != BCRYPT_ROUNDS
@@ -0,0 +1,158 @@
+"""
+Storage backends for uploaded images
+
+The backend is picked with the STORAGE_BACKEND environment variable:
+"s3" (default) stores images in S3_BUCKET_NAME, "local" stores them in
+LOCAL_STORAGE_DIR and serves them from the app's /assets/ route
+"""
+
+import os
+import threading
+from io import BytesIO
+
+from metrics import STORAGE_UPLOAD_TIME
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_REGION = os.environ.get("S3_REGION", os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024))
+
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.getcwd(), "assets"))
+LOCAL_STORAGE_URL = os.environ.get("LOCAL_STORAGE_URL", "http://localhost:8000/assets")
+
+
+class S3Storage:
+    """
+    Stores images in an S3 bucket through one long-lived client
+    """
+
+    def __init__(self, bucket_name, region):
+        """
+        Initializes the S3 client and its connection pool
+        """
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket_name = bucket_name
+        self.base_url = f"https://{bucket_name}.s3.{region}.amazonaws.com"
+        self.client = boto3.client(
+            "s3",
+            region_name=region,
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={"max_attempts": 3, "mode": "standard"}
+            )
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=4
+        )
+
+    def put(self, key, body, content_type):
+        """
+        Uploads the bytes as a public object; bodies above the multipart
+        threshold are sent as a multipart upload
+        """
+        with STORAGE_UPLOAD_TIME.time(backend="s3"):
+            self.client.upload_fileobj(
+                BytesIO(body),
+                self.bucket_name,
+                key,
+                ExtraArgs={"ACL": "public-read", "ContentType": content_type},
+                Config=self.transfer_config
+            )
+
+    def get(self, key):
+        """
+        Returns the bytes of the object with the given key
+        """
+        return self.client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+
+    def delete(self, keys):
+        """
+        Deletes the objects with the given keys, up to 1000 per request
+
+        Returns the keys that could not be deleted
+        """
+        failed = []
+        for i in range(0, len(keys), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True}
+            )
+            failed += [error["Key"] for error in response.get("Errors", [])]
+        return failed
+
+
+class LocalStorage:
+    """
+    Stores images in a directory on local disk
+    """
+
+    def __init__(self, directory, base_url):
+        """
+        Initializes the storage directory
+        """
+        self.directory = directory
+        self.base_url = base_url
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key, body, content_type):
+        """
+        Writes the bytes to disk, replacing the file atomically
+        """
+        path = os.path.join(self.directory, key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with STORAGE_UPLOAD_TIME.time(backend="local"):
+            with open(temp_path, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, path)
+
+    def get(self, key):
+        """
+        Returns the bytes of the file with the given key
+        """
+        with open(os.path.join(self.directory, key), "rb") as f:
+            return f.read()
+
+    def delete(self, keys):
+        """
+        Deletes the files with the given keys, ignoring missing ones
+
+        Returns the keys that could not be deleted
+        """
+        failed = []
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed.append(key)
+        return failed
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    Returns the storage backend shared by the whole process
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "local":
+                    _storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_URL)
+                elif STORAGE_BACKEND == "s3":
+                    _storage = S3Storage(S3_BUCKET_NAME, S3_REGION)
+                else:
+                    raise ValueError(f"Unknown storage backend {STORAGE_BACKEND}")
+    return _storage
@@ -0,0 +1,201 @@
+"""
+Outfit suggestions from color features
+
+Each asset gets a small palette when it is ingested (see
+Asset.process): its PALETTE_SIZE most common colors with their share of
+the garment, packed into PALETTE_SIZE * 4 bytes. Suggestions score
+every headwear/top/bottom/shoes combination of a wardrobe at once with
+NumPy, as the mean color compatibility of each pair of pieces in the
+outfit. NumPy is only imported when suggestions are first requested
+"""
+
+import os
+
+SLOTS = ["headwear", "top", "bottom", "shoes"]
+PALETTE_SIZE = 4
+PALETTE_SAMPLE_SIZE = 64
+
+# largest number of combinations scored at once; bigger wardrobes keep
+# only the pieces of each slot that pair best with the other slots
+SUGGESTION_MAX_COMBINATIONS = int(os.environ.get("SUGGESTION_MAX_COMBINATIONS", 2_000_000))
+
+# hue distances, as fractions of the color wheel, of the harmonies that
+# score well (analogous, triadic, complementary) and how far off a pair
+# can be to still count
+HARMONIES = [0, 1 / 3, 1 / 2]
+HARMONY_TOLERANCE = 1 / 12
+CONTRAST_WEIGHT = 0.25
+
+
+def extract_palette(img):
+    """
+    Returns the packed palette of an image: up to PALETTE_SIZE
+    (r, g, b, weight) entries, most common first, with weights out of
+    255. Transparent pixels are ignored; for opaque images only the
+    center of the image is used, since that is where the garment
+    usually is. Returns None if there are no opaque pixels
+    """
+    from PIL import Image
+
+    small = img.convert("RGBA")
+    if small.getextrema()[3][0] == 255:
+        width, height = small.size
+        small = small.crop((width // 5, height // 5, width - width // 5, height - height // 5))
+    small.thumbnail((PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE))
+    opaque = [pixel[:3] for pixel in small.getdata() if pixel[3] >= 128]
+    if not opaque:
+        return None
+
+    pixels = Image.new("RGB", (len(opaque), 1))
+    pixels.putdata(opaque)
+    quantized = pixels.quantize(colors=PALETTE_SIZE, method=Image.Quantize.MEDIANCUT)
+    colors = quantized.getpalette()
+    palette = bytearray()
+    for count, index in sorted(quantized.getcolors(), reverse=True)[:PALETTE_SIZE]:
+        palette += bytes(colors[3 * index:3 * index + 3])
+        palette.append(round(255 * count / len(opaque)))
+    return bytes(palette.ljust(PALETTE_SIZE * 4, b"\0"))
+
+
+def decode_palette(palette):
+    """
+    Returns the colors of a packed palette as a list of
+    {"color": "#rrggbb", "weight": share} items
+    """
+    if palette is None:
+        return []
+    return [
+        {"color": "#{:02x}{:02x}{:02x}".format(*palette[i:i + 3]), "weight": round(palette[i + 3] / 255, 3)}
+        for i in range(0, len(palette), 4)
+        if palette[i + 3]
+    ]
+
+
+def color_features(palettes):
+    """
+    Returns the hue (as a unit vector), saturation and value of each
+    packed palette, averaged over its colors by weight. A missing
+    palette counts as a neutral mid gray
+    """
+    import numpy as np
+
+    neutral = bytes([128, 128, 128, 255]) + b"\0" * (PALETTE_SIZE - 1) * 4
+    raw = np.frombuffer(b"".join(palette or neutral for palette in palettes), dtype=np.uint8)
+    raw = raw.reshape(len(palettes), PALETTE_SIZE, 4).astype(np.float32) / 255
+    rgb, weight = raw[:, :, :3], raw[:, :, 3]
+    weight = weight / np.maximum(weight.sum(axis=1, keepdims=True), 1e-6)
+
+    value = rgb.max(axis=2)
+    chroma = value - rgb.min(axis=2)
+    saturation = np.where(value > 0, chroma / np.maximum(value, 1e-6), 0)
+    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    safe_chroma = np.maximum(chroma, 1e-6)
+    hue = np.select(
+        [value == r, value == g],
+        [((g - b) / safe_chroma) % 6, (b - r) / safe_chroma + 2],
+        (r - g) / safe_chroma + 4
+    ) / 6
+    angle = 2 * np.pi * hue
+    # colors weigh into the mean hue by how saturated they are
+    hue_vector = np.stack([np.cos(angle), np.sin(angle)], axis=2) * (weight * saturation)[:, :, None]
+    hue_vector = hue_vector.sum(axis=1)
+    hue_vector /= np.maximum(np.linalg.norm(hue_vector, axis=1, keepdims=True), 1e-6)
+    return hue_vector, (weight * saturation).sum(axis=1), (weight * value).sum(axis=1)
+
+
+def pair_scores(a, b):
+    """
+    Returns the color compatibility, from 0 to 1 + CONTRAST_WEIGHT, of
+    every piece in a with every piece in b, given their color_features.
+    Neutral colors go with anything, saturated colors score by how close
+    their hues are to a harmony, and contrasting lightness adds a little
+    """
+    import numpy as np
+
+    (hue_a, saturation_a, value_a), (hue_b, saturation_b, value_b) = a, b
+    cosine = np.clip(hue_a @ hue_b.T, -1, 1)
+    distance = np.arccos(cosine) / (2 * np.pi)
+    harmony = np.zeros_like(distance)
+    for target in HARMONIES:
+        harmony = np.maximum(harmony, 1 - np.abs(distance - target) / HARMONY_TOLERANCE)
+    colorful = np.outer(saturation_a, saturation_b)
+    contrast = np.abs(value_a[:, None] - value_b[None, :])
+    return ((1 - colorful) + colorful * harmony + CONTRAST_WEIGHT * contrast).astype(np.float32)
+
+
+def _slot_limits(sizes, budget):
+    """
+    Returns how many pieces to keep per slot so that the product stays
+    within budget, sharing it out from the smallest slot up
+    """
+    limits = list(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for position, i in enumerate(order):
+        share = max(int(remaining ** (1 / (len(sizes) - position)) + 1e-9), 1)
+        limits[i] = min(sizes[i], share)
+        remaining = max(remaining // limits[i], 1)
+    return limits
+
+
+def suggest(wardrobe, k):
+    """
+    Scores every combination of one piece per slot in the wardrobe, a
+    dict of slot to list of (clothing_id, packed palette), and returns
+    the k best as (score, {slot: clothing_id}) pairs, best first. Empty
+    slots are left out of the outfit; at least two slots must have pieces
+    """
+    import numpy as np
+
+    slots = [slot for slot in SLOTS if wardrobe.get(slot)]
+    if len(slots) < 2:
+        return []
+    ids = [np.array([clothing_id for clothing_id, _ in wardrobe[slot]]) for slot in slots]
+    features = [color_features([palette for _, palette in wardrobe[slot]]) for slot in slots]
+    pairs = [(i, j) for i in range(len(slots)) for j in range(i + 1, len(slots))]
+    scores = {(i, j): pair_scores(features[i], features[j]) for i, j in pairs}
+
+    sizes = [len(slot_ids) for slot_ids in ids]
+    limits = _slot_limits(sizes, SUGGESTION_MAX_COMBINATIONS)
+    if limits != sizes:
+        # keep the pieces whose best match in every other slot is strongest
+        for i in range(len(slots)):
+            if limits[i] == sizes[i]:
+                continue
+            affinity = sum(
+                scores[(i, j)].max(axis=1) if i < j else scores[(j, i)].max(axis=0)
+                for j in range(len(slots)) if j != i
+            )
+            keep = np.sort(np.argpartition(-affinity, limits[i] - 1)[:limits[i]])
+            ids[i] = ids[i][keep]
+            for j in range(len(slots)):
+                if i < j:
+                    scores[(i, j)] = scores[(i, j)][keep, :]
+                elif j < i:
+                    scores[(j, i)] = scores[(j, i)][:, keep]
+
+    total = np.zeros([len(slot_ids) for slot_ids in ids], dtype=np.float32)
+    for (i, j), matrix in scores.items():
+        shape = [1] * len(slots)
+        shape[i], shape[j] = matrix.shape
+        total += matrix.reshape(shape)
+
+    # the k best scores lie in at most k rows along the last slot, so
+    # only the rows with the k best maxima need a full partition
+    rows = total.reshape(-1, total.shape[-1])
+    k = min(k, total.size)
+    top_rows = np.argpartition(rows.max(axis=1), max(rows.shape[0] - k, 0))[-k:]
+    candidates = rows[top_rows].ravel()
+    best = np.argpartition(candidates, candidates.size - k)[-k:]
+    best = best[np.argsort(-candidates[best], kind="stable")]
+    flat_indices = top_rows[best // rows.shape[1]] * rows.shape[1] + best % rows.shape[1]
+    return [
+        (
+            float(candidates[index]) / len(pairs),
+            {
+                slot: int(ids[i][position])
+                for i, (slot, position) in enumerate(zip(slots, np.unravel_index(flat_index, total.shape)))
+            }
+        )
+        for index, flat_index in zip(best, flat_indices)
+    ]
@@ -0,0 +1,130 @@
+"""
+Shared fixtures: a fresh app on its own SQLite file for each test, with
+images stored in a temporary directory and the list cache, admission
+limits and password process pool turned off
+"""
+
+import base64
+import datetime
+import os
+import sys
+import tempfile
+from io import BytesIO
+
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+
+# read when the app's modules are imported
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_STORAGE_DIR", tempfile.mkdtemp(prefix="ootd-test-assets-"))
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("LIST_CACHE_SIZE", "0")
+for name in ["PASSWORD", "UPLOAD"]:
+    for limit in ["CONCURRENCY", "RATE"]:
+        os.environ.setdefault(f"{name}_ROUTE_{limit}", "0")
+
+from config import Config  # noqa: E402
+
+CLASSIFICATIONS = ["headwear", "top", "bottom", "shoes"]
+
+
+@pytest.fixture
+def make_app():
+    """
+    Returns a function creating an app on the SQLite file at a path and
+    migrating it, whether the file is new or holds an older schema
+    """
+    from app import create_app
+    from db import db
+    from migrations import migrate
+
+    apps = []
+
+    def make(path):
+        class TestConfig(Config):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+            SECRET_KEY = "test"
+            TESTING = True
+
+        app = create_app(TestConfig)
+        with app.app_context():
+            migrate()
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app, tmp_path):
+    """
+    Returns an app on a new, migrated database
+    """
+    return make_app(tmp_path / "test.db")
+
+
+@pytest.fixture
+def client(app):
+    """
+    Returns a test client of the app
+    """
+    return app.test_client()
+
+
+@pytest.fixture
+def image_uri():
+    """
+    Returns a 300x200 PNG as a base64 data URI, big enough for one
+    thumbnail
+    """
+    from PIL import Image
+    buffer = BytesIO()
+    Image.new("RGB", (300, 200), (200, 30, 30)).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+@pytest.fixture
+def wardrobe(app):
+    """
+    Returns a function adding a user with the given number of clothing
+    items and outfits straight to the database, returning the username;
+    the clothing cycles through the four classifications
+    """
+    from db import db
+    from db import Asset
+    from db import Clothing
+    from db import Outfit
+    from db import User
+
+    def add(username, clothing=0, outfits=0):
+        with app.app_context():
+            user_id = db.session.execute(User.__table__.insert().values(
+                username=username, password_digest="x", token_version=0, data_version=0
+            )).inserted_primary_key[0]
+            clothing_ids = []
+            for i in range(clothing):
+                asset_id = db.session.execute(Asset.__table__.insert().values(
+                    base_url="http://localhost/assets", salt=f"{username}{i}", extension="png",
+                    width=10, height=10, created_at=datetime.datetime.now(), status="ready",
+                    content_hash=f"{username}{i}", ref_count=1
+                )).inserted_primary_key[0]
+                clothing_ids.append(db.session.execute(Clothing.__table__.insert().values(
+                    asset_id=asset_id, classification=CLASSIFICATIONS[i % 4], user_id=user_id
+                )).inserted_primary_key[0])
+            for i in range(outfits):
+                db.session.execute(Outfit.__table__.insert().values(
+                    name=f"outfit{i}", user_id=user_id,
+                    **{slot: clothing_ids[(4 * i + j) % clothing] if clothing else None
+                       for j, slot in enumerate(["headwear_id", "top_id", "bottom_id", "shoes_id"])}
+                ))
+            db.session.commit()
+        return username
+
+    return add
@@ -0,0 +1,161 @@
+"""
+Assets uploaded to the local storage backend
+"""
+
+import base64
+import json
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+
+import db as db_module
+import users_dao
+from db import User
+
+
+def test_upload_on_request_thread_bumps_data_version(app, client, wardrobe, image_uri, monkeypatch):
+    # a full upload queue makes start_upload upload on the request thread
+    full = threading.BoundedSemaphore(1)
+    full.acquire()
+    monkeypatch.setattr(db_module, "upload_slots", full)
+    wardrobe("a")
+    response = client.post("/clothing/batch/", data=json.dumps({"username": "a", "items": [
+        {"classification": "top", "image_data": image_uri}
+    ]}))
+    assert response.status_code == 201, response.data
+    asset_id = json.loads(response.data)["results"][0]["id"]
+    asset = json.loads(client.get(f"/asset/{asset_id}/").data)
+    assert asset["status"] == "ready"
+    assert set(asset["variants"]) == {"128"}
+    with app.app_context():
+        # once for the batch, once for the thumbnail links
+        assert User.query.filter_by(username="a").one().data_version == 2
+    listed = client.post("/clothing/list/", data=json.dumps({"username": "a", "size": 100}))
+    assert json.loads(listed.data)["assets"][0]["url"] == asset["variants"]["128"]["url"]
+
+
+def poll(client, asset_id, timeout=10):
+    """
+    Polls GET /asset/<id>/ until the asset is no longer pending
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        asset = json.loads(client.get(f"/asset/{asset_id}/").data)
+        if asset["status"] != "pending" or time.monotonic() > deadline:
+            return asset
+        time.sleep(0.02)
+
+
+def decode_count(client):
+    """
+    Returns how many image decodes /metrics has recorded
+    """
+    for line in client.get("/metrics").data.decode("utf8").splitlines():
+        if line.startswith("image_decode_seconds_count"):
+            return float(line.split()[-1])
+    return 0
+
+
+def test_image_is_decoded_and_timed_in_the_upload(client, wardrobe, image_uri):
+    wardrobe("a")
+    before = decode_count(client)
+    response = client.post("/clothing/create/", data=json.dumps({
+        "username": "a", "classification": "top", "image_data": image_uri
+    }))
+    assert poll(client, json.loads(response.data)["id"])["status"] == "ready"
+    assert decode_count(client) == before + 1
+
+
+def test_truncated_image_fails(client, wardrobe, image_uri):
+    wardrobe("a")
+    data = base64.b64decode(image_uri.partition(",")[2])
+    truncated = "data:image/png;base64," + base64.b64encode(data[:len(data) // 2]).decode("ascii")
+    response = client.post("/clothing/create/", data=json.dumps({
+        "username": "a", "classification": "top", "image_data": truncated
+    }))
+    assert response.status_code == 201, response.data
+    assert poll(client, json.loads(response.data)["id"])["status"] == "failed"
+
+
+def test_upload_batch_reports_bad_items_per_item(app, client, wardrobe, image_uri):
+    wardrobe("a")
+    response = client.post("/clothing/batch/", data=json.dumps({"username": "a", "items": [
+        {"classification": "top", "image_data": image_uri},
+        {"image_data": image_uri},
+        "top",
+        {"classification": "", "image_data": image_uri},
+    ]}))
+    assert response.status_code == 201, response.data
+    results = json.loads(response.data)["results"]
+    assert "id" in results[0]
+    assert results[1:] == [
+        {"error": "Missing classification"}, {"error": "Invalid item"}, {"error": "Missing classification"}
+    ]
+    with app.app_context():
+        assert db_module.Asset.query.one().ref_count == 1
+
+
+def test_rejected_upload_stores_no_asset(app, client, wardrobe, image_uri):
+    wardrobe("a")
+    response = client.post("/clothing/create/", data=json.dumps({"username": "a", "image_data": image_uri}))
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": "Missing classification"}
+    response = client.post("/clothing/create/", data=json.dumps({
+        "username": "nobody", "classification": "top", "image_data": image_uri
+    }))
+    assert response.status_code == 404
+    with app.app_context():
+        assert db_module.Asset.query.count() == 0
+
+
+def test_asset_is_stored_with_its_clothing(app, client, wardrobe, image_uri, monkeypatch):
+    wardrobe("a")
+
+    def fail(user_id):
+        raise RuntimeError("clothing insert failed")
+
+    monkeypatch.setattr(users_dao, "bump_data_version", fail)
+    with pytest.raises(RuntimeError):
+        client.post("/clothing/create/", data=json.dumps({
+            "username": "a", "classification": "top", "image_data": image_uri
+        }))
+    with app.app_context():
+        assert db_module.Asset.query.count() == 0
+
+
+def data_uri(mime_type, data):
+    """
+    Returns bytes as a base64 data URI
+    """
+    return f"data:{mime_type};base64," + base64.b64encode(data).decode("ascii")
+
+
+def png_header(width, height):
+    """
+    Returns the signature and IHDR chunk of a PNG of the given size
+    """
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + ihdr + struct.pack(
+        ">I", zlib.crc32(b"IHDR" + ihdr)
+    )
+
+
+@pytest.mark.parametrize("image_data, code, error", [
+    ("data:image/png;base64,!!!", 400, "Image is not valid base64"),
+    (data_uri("image/png", png_header(100_000, 100_000)), 413, "Image has more than 50000000 pixels"),
+    # start of image and a quantization table, then nothing: no start of frame
+    (data_uri("image/jpeg", b"\xff\xd8\xff\xdb\x00\x43" + bytes(65)), 415, "Corrupt JPEG header"),
+    (data_uri("image/png", b"this is not an image at all"), 415, "Image must be a PNG, JPEG or GIF"),
+], ids=["bad base64", "too many pixels", "jpeg without frame", "not an image"])
+def test_invalid_images_are_rejected_from_their_header(app, client, wardrobe, image_data, code, error):
+    wardrobe("a")
+    response = client.post("/clothing/create/", data=json.dumps({
+        "username": "a", "classification": "top", "image_data": image_data
+    }))
+    assert response.status_code == code
+    assert json.loads(response.data) == {"error": error}
+    with app.app_context():
+        assert db_module.Asset.query.count() == 0
@@ -0,0 +1,21 @@
+"""
+Configuration profiles
+"""
+
+import pytest
+
+import config
+from app import create_app
+
+
+def test_production_requires_secret_key(tmp_path):
+    class NoSecret(config.ProductionConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path}/test.db"
+        SECRET_KEY = None
+
+    with pytest.raises(ValueError, match="SECRET_KEY"):
+        create_app(NoSecret)
+
+
+def test_development_falls_back_to_a_random_key():
+    assert config.DevelopmentConfig.SECRET_KEY
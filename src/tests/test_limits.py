@@ -0,0 +1,51 @@
+"""
+Admission control
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import limits
+from conftest import SRC_DIR
+
+
+def default_limits(**settings):
+    """
+    Returns the limiters of limits.py imported with the given settings
+    and no others
+    """
+    env = {name: value for name, value in os.environ.items() if "_ROUTE_" not in name and name != "WEB_THREADS"}
+    result = subprocess.run(
+        [sys.executable, "-c", "import json, limits; print(json.dumps(limits.state()))"],
+        cwd=SRC_DIR, env=dict(env, **settings), capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout)["limiters"]
+
+
+def test_default_concurrency_leaves_one_thread():
+    state = default_limits()
+    assert state["password"]["concurrency"] == 3
+    assert state["upload"]["concurrency"] == 2
+    state = default_limits(WEB_THREADS="8")
+    assert state["password"]["concurrency"] == 7
+    assert state["upload"]["concurrency"] == 4
+
+
+def test_concurrent_logins_are_admitted():
+    limiter = limits.RouteLimiter("test", 3, 0, 0, limits.MemoryBucketStore(10))
+    assert limiter.admit("a") is None
+    assert limiter.admit("b") is None
+    assert limiter.admit("c") is None
+    assert limiter.admit("d") == (503, limits.BUSY_RETRY_AFTER)
+    limiter.release()
+    assert limiter.admit("d") is None
+
+
+def test_rate_limit_asks_to_retry():
+    limiter = limits.RouteLimiter("test", 0, 60, 1, limits.MemoryBucketStore(10))
+    assert limiter.admit("a") is None
+    limiter.release()
+    assert limiter.admit("a") == (429, 1)
+    assert limiter.admit("b") is None
@@ -0,0 +1,90 @@
+"""
+List responses carry an ETag naming the user's data version: a client
+with the current version gets a 304, and every write changes the ETag
+"""
+
+import json
+
+import pytest
+
+import app as app_module
+from db import User
+from list_cache import ListCache
+
+
+@pytest.fixture
+def list_cache(monkeypatch):
+    """
+    Turns the list cache on for one test
+    """
+    cache = ListCache(16)
+    monkeypatch.setattr(app_module, "list_cache", cache)
+    return cache
+
+
+def data_version(app, username):
+    """
+    Returns the data version of a user
+    """
+    with app.app_context():
+        return User.query.filter_by(username=username).one().data_version
+
+
+def test_repeated_list_with_etag_is_304(client, wardrobe, list_cache):
+    wardrobe("a", clothing=4)
+    body = json.dumps({"username": "a"})
+    first = client.post("/clothing/list/", data=body)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+    again = client.post("/clothing/list/", data=body, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b""
+    assert again.headers["ETag"] == etag
+    # other parameters are another response with another ETag
+    other = client.post("/clothing/list/", data=json.dumps({"username": "a", "limit": 2}), headers={"If-None-Match": etag})
+    assert other.status_code == 200
+    assert other.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("route, params", [
+    ("/outfit/create/", {"name": "new"}),
+    ("/tag/", {"label": "red", "outfit_name": "outfit0"}),
+])
+def test_write_changes_the_etag(app, client, wardrobe, list_cache, route, params):
+    wardrobe("a", clothing=4, outfits=1)
+    body = json.dumps({"username": "a"})
+    first = client.post("/outfit/list/", data=body)
+    etag = first.headers["ETag"]
+    version = data_version(app, "a")
+
+    response = client.post(route, data=json.dumps(dict(params, username="a")))
+    assert response.status_code == 201, response.data
+    assert data_version(app, "a") == version + 1
+
+    after = client.post("/outfit/list/", data=body, headers={"If-None-Match": etag})
+    assert after.status_code == 200
+    assert after.headers["ETag"] != etag
+    if route == "/outfit/create/":
+        assert [outfit["name"] for outfit in json.loads(after.data)["outfits"]] == ["outfit0", "new"]
+
+
+def test_delete_changes_the_etag(app, client, wardrobe, list_cache):
+    wardrobe("a", clothing=4)
+    body = json.dumps({"username": "a"})
+    etag = client.post("/clothing/list/", data=body).headers["ETag"]
+    assert client.delete("/clothing/1/").status_code == 200
+    after = client.post("/clothing/list/", data=body, headers={"If-None-Match": etag})
+    assert after.status_code == 200
+    assert [asset["id"] for asset in json.loads(after.data)["assets"]] == [2, 3, 4]
+
+
+def test_list_cache_evicts_least_recently_used():
+    cache = ListCache(2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
@@ -0,0 +1,68 @@
+"""
+The list routes must run the same number of queries whatever the number
+of items they return
+"""
+
+import json
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from db import db
+
+
+@contextmanager
+def count_queries(app):
+    """
+    Yields the list of SQL statements run on the app's engine meanwhile
+    """
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+LIST_CALLS = [
+    ("/clothing/list/", {}),
+    ("/clothing/filter/", {"classification": "top"}),
+    ("/outfit/list/", {}),
+    ("/outfit/list/", {"expand": True}),
+]
+
+
+@pytest.mark.parametrize("route, params", LIST_CALLS)
+def test_list_query_count_is_constant(app, client, wardrobe, route, params):
+    counts = []
+    for username, items in [("one", 1), ("many", 40)]:
+        wardrobe(username, clothing=4 * items, outfits=items)
+        with count_queries(app) as statements:
+            response = client.post(route, data=json.dumps(dict(params, username=username, limit=200)))
+        assert response.status_code == 200, response.data
+        listed = json.loads(response.data)
+        assert isinstance(listed["assets" if route.startswith("/clothing/") else "outfits"], list)
+        counts.append(len(statements))
+    assert counts[0] == counts[1], counts
+
+
+def test_clothing_list_links_every_item(client, wardrobe):
+    wardrobe("a", clothing=8)
+    response = client.post("/clothing/list/", data=json.dumps({"username": "a"}))
+    assets = json.loads(response.data)["assets"]
+    assert [asset["id"] for asset in assets] == list(range(1, 9))
+    assert assets[0] == {"id": 1, "classification": "headwear", "url": "http://localhost/assets/a0.png"}
+
+
+@pytest.mark.parametrize("route", ["/clothing/list/", "/clothing/filter/", "/outfit/list/"])
+def test_list_of_unknown_user_is_404(client, route):
+    response = client.post(route, data=json.dumps({"username": "nobody", "classification": "top"}))
+    assert response.status_code == 404
+    assert json.loads(response.data) == {"error": "User not found"}
@@ -0,0 +1,87 @@
+"""
+Outfit and tag routes
+"""
+
+import json
+
+
+def test_create_outfit_rejects_missing_clothing(client, wardrobe):
+    wardrobe("a", clothing=4)
+    response = client.post("/outfit/create/", data=json.dumps({"username": "a", "name": "o1", "top_id": 999}))
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": "Clothing not found for top_id"}
+
+
+def test_create_outfit_rejects_other_users_clothing(client, wardrobe):
+    wardrobe("a", clothing=4)
+    wardrobe("b", clothing=4)
+    response = client.post("/outfit/create/", data=json.dumps({"username": "b", "name": "o1", "top_id": 2}))
+    assert response.status_code == 400
+    response = client.post("/outfit/create/", data=json.dumps({"username": "b", "name": "o1", "top_id": 6}))
+    assert response.status_code == 201
+
+
+def test_outfit_batch_reports_bad_clothing_per_item(client, wardrobe):
+    wardrobe("a", clothing=4)
+    response = client.post("/outfit/batch/", data=json.dumps({"username": "a", "outfits": [
+        {"name": "good", "headwear_id": 1, "top_id": 2, "bottom_id": 3, "shoes_id": 4},
+        {"name": "bad", "shoes_id": 999},
+        {"name": "empty"},
+    ]}))
+    assert response.status_code == 201
+    results = json.loads(response.data)["results"]
+    assert results[0]["name"] == "good"
+    assert results[1] == {"error": "Clothing not found for shoes_id"}
+    assert results[2]["name"] == "empty"
+    listed = client.post("/outfit/list/", data=json.dumps({"username": "a"}))
+    assert [outfit["name"] for outfit in json.loads(listed.data)["outfits"]] == ["good", "empty"]
+
+
+def test_add_tag_only_tags_the_users_outfit(client, wardrobe):
+    wardrobe("a", clothing=4, outfits=1)
+    wardrobe("b", clothing=4, outfits=1)
+    response = client.post("/tag/", data=json.dumps({"username": "b", "label": "red", "outfit_name": "outfit0"}))
+    assert response.status_code == 201
+    found = client.post("/outfit/search/", data=json.dumps({"username": "b", "tags": ["red"]}))
+    assert [outfit["id"] for outfit in json.loads(found.data)["outfits"]] == [2]
+    found = client.post("/outfit/search/", data=json.dumps({"username": "a", "tags": ["red"]}))
+    assert json.loads(found.data)["outfits"] == []
+
+
+def test_add_tag_requires_username_and_outfit(client, wardrobe):
+    wardrobe("a", clothing=4, outfits=1)
+    response = client.post("/tag/", data=json.dumps({"label": "red", "outfit_name": "outfit0"}))
+    assert response.status_code == 400
+    response = client.post("/tag/", data=json.dumps({"username": "a", "label": "red", "outfit_name": "nope"}))
+    assert response.status_code == 404
+
+
+def test_outfit_batch_reports_invalid_items(client, wardrobe):
+    wardrobe("a", clothing=4)
+    response = client.post("/outfit/batch/", data=json.dumps({"username": "a", "outfits": [
+        "o1", {"name": ["o2"]}, {"name": "o3", "top_id": 2}
+    ]}))
+    assert response.status_code == 201, response.data
+    results = json.loads(response.data)["results"]
+    assert results[:2] == [{"error": "Invalid item"}, {"error": "Missing name"}]
+    assert results[2]["name"] == "o3"
+
+
+def test_tag_batch_reports_invalid_items(client, wardrobe):
+    wardrobe("a", clothing=4, outfits=1)
+    response = client.post("/tag/batch/", data=json.dumps({"username": "a", "tags": [
+        "red", {"label": ["red"], "outfit_name": "outfit0"}, {"label": "red", "outfit_name": ["outfit0"]},
+        {"label": "red", "outfit_name": "outfit0"}
+    ]}))
+    assert response.status_code == 201, response.data
+    results = json.loads(response.data)["results"]
+    assert results[:3] == [{"error": "Invalid item"}, {"error": "Label not present"}, {"error": "Outfit not found"}]
+    assert results[3]["label"] == "red"
+
+
+def test_search_rejects_tags_that_are_not_strings(client, wardrobe):
+    wardrobe("a", clothing=4, outfits=1)
+    for tags in [["red", 1], [["red"]], [{"label": "red"}]]:
+        response = client.post("/outfit/search/", data=json.dumps({"username": "a", "tags": tags}))
+        assert response.status_code == 400
+        assert json.loads(response.data) == {"error": "Tags must be strings"}
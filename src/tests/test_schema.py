@@ -0,0 +1,168 @@
+"""
+Schema and indexes: the hot queries must be answered from indexes, and
+migrating a database created before migrations existed must give the
+same schema as creating a new one
+"""
+
+import json
+import re
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+from db import db
+
+# the schema db.create_all() built before migrations, schema version 0
+BASELINE_SCHEMA = [
+    """CREATE TABLE assets (
+        id INTEGER NOT NULL, base_url VARCHAR NOT NULL, salt VARCHAR NOT NULL,
+        extension VARCHAR NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL,
+        created_at DATETIME NOT NULL, PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE user (
+        id INTEGER NOT NULL, username VARCHAR NOT NULL, password_digest VARCHAR NOT NULL,
+        session_token VARCHAR NOT NULL, session_expiration DATETIME NOT NULL, update_token VARCHAR NOT NULL,
+        PRIMARY KEY (id), UNIQUE (username), UNIQUE (session_token), UNIQUE (update_token)
+    )""",
+    """CREATE TABLE tag (
+        id INTEGER NOT NULL, label VARCHAR NOT NULL, PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE clothing (
+        id INTEGER NOT NULL, asset_id INTEGER NOT NULL, classification VARCHAR NOT NULL,
+        user_id INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE outfit (
+        id INTEGER NOT NULL, name VARCHAR NOT NULL, headwear_id INTEGER, top_id INTEGER,
+        bottom_id INTEGER, shoes_id INTEGER, user_id INTEGER, PRIMARY KEY (id),
+        FOREIGN KEY(headwear_id) REFERENCES clothing (id), FOREIGN KEY(top_id) REFERENCES clothing (id),
+        FOREIGN KEY(bottom_id) REFERENCES clothing (id), FOREIGN KEY(shoes_id) REFERENCES clothing (id),
+        FOREIGN KEY(user_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE "association table" (
+        outfit_id INTEGER, tag_id INTEGER,
+        FOREIGN KEY(outfit_id) REFERENCES outfit (id), FOREIGN KEY(tag_id) REFERENCES tag (id)
+    )""",
+]
+
+HOT_TABLES = {"clothing", "outfit", "tag", "association table"}
+
+# plan lines each hot query must produce
+HOT_QUERY_PLANS = {
+    "clothing by user": r"SEARCH clothing USING (COVERING )?INDEX \w+ \(user_id=\?",
+    "clothing by user and classification": r"SEARCH clothing USING (COVERING )?INDEX \w+ \(user_id=\? AND classification=\?",
+    "outfit by user": r"SEARCH outfit USING (COVERING )?INDEX \w+ \(user_id=\? AND rowid>\?",
+    "outfit by user and name": r"SEARCH outfit USING (COVERING )?INDEX \w+ \(user_id=\? AND name=\?\)",
+    "tag by label": r"SEARCH tag USING (COVERING )?INDEX \w+ \(label=\?\)",
+}
+
+
+def create_baseline(path):
+    """
+    Creates a version 0 database at path with a user, clothing, an outfit
+    and a tag
+    """
+    connection = sqlite3.connect(path)
+    for statement in BASELINE_SCHEMA:
+        connection.execute(statement)
+    connection.execute("INSERT INTO user VALUES (1, 'a', 'x', 's', '2023-01-01 00:00:00', 'u')")
+    connection.execute("INSERT INTO assets VALUES (1, 'http://localhost/assets', 'S', 'png', 1, 1, '2023-01-01')")
+    connection.execute("INSERT INTO clothing VALUES (1, 1, 'top', 1)")
+    connection.execute("INSERT INTO outfit VALUES (1, 'o', NULL, 1, NULL, NULL, 1)")
+    connection.execute("INSERT INTO tag VALUES (1, 'red')")
+    connection.execute('INSERT INTO "association table" VALUES (1, 1)')
+    connection.commit()
+    connection.close()
+
+
+def schema(path):
+    """
+    Returns the columns, indexes and foreign keys of every table
+
+    Column defaults are left out: SQLite needs one to add a NOT NULL
+    column to an existing table, while new tables get their defaults
+    from the models
+    """
+    connection = sqlite3.connect(path)
+    tables = [name for (name,) in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    )]
+    result = {}
+    for table in tables:
+        quoted = table.replace('"', '""')
+        result[table] = {
+            "columns": [(name, kind, notnull, pk) for _, name, kind, notnull, _, pk in connection.execute(
+                f'PRAGMA table_info("{quoted}")'
+            )],
+            "indexes": sorted(
+                (index, unique, [column for _, _, column in connection.execute(f'PRAGMA index_info("{index}")')])
+                for _, index, unique, _, _ in connection.execute(f'PRAGMA index_list("{quoted}")')
+            ),
+            "foreign_keys": sorted(row[2:] for row in connection.execute(f'PRAGMA foreign_key_list("{quoted}")')),
+        }
+    connection.close()
+    return result
+
+
+def test_migrated_baseline_matches_new_database(make_app, tmp_path):
+    create_baseline(tmp_path / "baseline.db")
+    make_app(tmp_path / "baseline.db")
+    make_app(tmp_path / "new.db")
+    assert schema(tmp_path / "baseline.db") == schema(tmp_path / "new.db")
+    connection = sqlite3.connect(tmp_path / "baseline.db")
+    assert connection.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert connection.execute("SELECT ref_count FROM assets").fetchall() == [(1,)]
+
+
+@pytest.fixture(params=["new", "migrated"])
+def app(request, make_app, tmp_path):
+    """
+    Returns an app on a new database, and on one migrated from version 0
+    """
+    if request.param == "migrated":
+        create_baseline(tmp_path / "test.db")
+        app = make_app(tmp_path / "test.db")
+        with app.app_context():
+            # start from an empty wardrobe, like a new database
+            for table in ['"association table"', "outfit", "tag", "clothing", "assets", '"user"']:
+                db.session.execute(db.text(f"DELETE FROM {table}"))
+            db.session.commit()
+        return app
+    return make_app(tmp_path / "test.db")
+
+
+def test_hot_queries_use_indexes(app, client, wardrobe):
+    wardrobe("a", clothing=40, outfits=10)
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        client.post("/clothing/list/", data=json.dumps({"username": "a"}))
+        client.post("/clothing/filter/", data=json.dumps({"username": "a", "classification": "top"}))
+        client.post("/outfit/list/", data=json.dumps({"username": "a", "expand": True}))
+        client.post("/outfit/create/", data=json.dumps({"username": "a", "name": "new"}))
+        client.post("/tag/", data=json.dumps({"username": "a", "label": "red", "outfit_name": "outfit1"}))
+        client.post("/outfit/search/", data=json.dumps({"username": "a", "tags": ["red"]}))
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    plans = []
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        try:
+            for statement, parameters in statements:
+                plan = [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+                for line in plan:
+                    match = re.match(r"SCAN (.+?)(?: USING|$)", line)
+                    assert match is None or match.group(1) not in HOT_TABLES, (statement, plan)
+                plans += plan
+        finally:
+            connection.close()
+    for query, pattern in HOT_QUERY_PLANS.items():
+        assert any(re.match(pattern, line) for line in plans), query
@@ -0,0 +1,35 @@
+"""
+Session tokens are revoked by bumping the user's token version
+"""
+
+import json
+
+from db import db
+from db import User
+
+
+def register(client, username):
+    """
+    Registers a user and returns the Authorization header of their session
+    """
+    response = client.post("/register/", data=json.dumps({"username": username, "password": "password"}))
+    return {"Authorization": f"Bearer {json.loads(response.data)['session_token']}"}
+
+
+def test_token_is_rejected_after_logout(client):
+    headers = register(client, "a")
+    assert client.post("/secret/", headers=headers).status_code == 200
+    assert client.post("/logout/", headers=headers).status_code == 200
+    response = client.post("/secret/", headers=headers)
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": "Invalid session token"}
+
+
+def test_token_is_rejected_after_logout_on_another_worker(app, client):
+    headers = register(client, "a")
+    assert client.post("/secret/", headers=headers).status_code == 200
+    # what /logout/ on another worker leaves behind: only the database changed
+    with app.app_context():
+        User.query.filter_by(username="a").update({"token_version": User.token_version + 1})
+        db.session.commit()
+    assert client.post("/secret/", headers=headers).status_code == 400
@@ -0,0 +1,85 @@
+"""
+Background uploads against a local S3 stand-in (moto): assets start out
+pending and become ready, or failed when the bucket cannot be written
+"""
+
+import json
+import threading
+import time
+
+import pytest
+
+import storage
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "ootd-test"
+
+
+def poll(client, asset_id, timeout=10):
+    """
+    Polls GET /asset/<id>/ until the asset is no longer pending
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        asset = json.loads(client.get(f"/asset/{asset_id}/").data)
+        if asset["status"] != "pending" or time.monotonic() > deadline:
+            return asset
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """
+    Points the storage backend at a mocked S3 and returns its client;
+    uploads wait for the returned gate to be set
+    """
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SECURITY_TOKEN", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(name, "testing")
+    with moto.mock_s3():
+        backend = storage.S3Storage(BUCKET, "us-east-1")
+        gate = threading.Event()
+        put = backend.put
+
+        def gated_put(key, body, content_type):
+            gate.wait(10)
+            put(key, body, content_type)
+
+        monkeypatch.setattr(backend, "put", gated_put)
+        monkeypatch.setattr(storage, "_storage", backend)
+        yield backend.client, gate
+
+
+def upload(client, wardrobe, image_uri):
+    wardrobe("a")
+    response = client.post("/clothing/create/", data=json.dumps({
+        "username": "a", "classification": "top", "image_data": image_uri
+    }))
+    assert response.status_code == 201, response.data
+    return json.loads(response.data)
+
+
+def test_upload_goes_from_pending_to_ready(client, wardrobe, image_uri, s3):
+    s3_client, gate = s3
+    s3_client.create_bucket(Bucket=BUCKET)
+    created = upload(client, wardrobe, image_uri)
+    assert created["status"] == "pending"
+    assert json.loads(client.get(f"/asset/{created['id']}/").data)["status"] == "pending"
+
+    gate.set()
+    asset = poll(client, created["id"])
+    assert asset["status"] == "ready"
+    assert asset["url"].startswith(f"https://{BUCKET}.s3.us-east-1.amazonaws.com/")
+    keys = {item["Key"] for item in s3_client.list_objects_v2(Bucket=BUCKET)["Contents"]}
+    assert asset["url"].rsplit("/", 1)[1] in keys
+    assert set(asset["variants"]) == {"128"}
+    assert asset["variants"]["128"]["url"].rsplit("/", 1)[1] in keys
+
+
+def test_upload_fails_without_bucket(client, wardrobe, image_uri, s3):
+    _, gate = s3
+    created = upload(client, wardrobe, image_uri)
+    assert created["status"] == "pending"
+    gate.set()
+    assert poll(client, created["id"])["status"] == "failed"
+
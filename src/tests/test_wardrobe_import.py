@@ -0,0 +1,92 @@
+"""
+Exporting a wardrobe and importing it into another user's wardrobe
+"""
+
+import json
+
+from db import db
+from db import Asset
+from db import Clothing
+from db import Outfit
+from db import User
+
+
+def auth(app, username):
+    """
+    Returns the Authorization header of a new session of a user
+    """
+    with app.app_context():
+        user = User.query.filter_by(username=username).one()
+        user.issue_tokens()
+        return {"Authorization": f"Bearer {user.session_token}"}
+
+
+def wardrobe_rows(app, username):
+    """
+    Returns a user's clothing as (id, asset id, classification) and
+    outfits as (name, slot ids, tag labels), in id order
+    """
+    with app.app_context():
+        user = User.query.filter_by(username=username).one()
+        clothing = [
+            (row.id, row.asset_id, row.classification)
+            for row in Clothing.query.filter_by(user_id=user.id).order_by(Clothing.id)
+        ]
+        outfits = [
+            (outfit.name, [outfit.headwear_id, outfit.top_id, outfit.bottom_id, outfit.shoes_id],
+             sorted(tag.label for tag in outfit.tags))
+            for outfit in Outfit.query.filter_by(user_id=user.id).order_by(Outfit.id)
+        ]
+        return clothing, outfits
+
+
+def test_export_imports_into_another_user(app, client, wardrobe):
+    wardrobe("a", clothing=8, outfits=2)
+    client.post("/tag/", data=json.dumps({"username": "a", "label": "red", "outfit_name": "outfit1"}))
+    # c's rows sit between a's ids and the ids b's import will get
+    wardrobe("c", clothing=4, outfits=1)
+    wardrobe("b")
+
+    export = client.get("/user/export/", headers=auth(app, "a"))
+    assert export.status_code == 200
+    lines = export.data.decode("utf8").splitlines()
+    assert [json.loads(line)["type"] for line in lines] == ["wardrobe"] + ["asset"] * 8 + ["clothing"] * 8 + ["outfit"] * 2
+    malformed = [
+        "not json",
+        "[1]",
+        json.dumps({"type": "scarf"}),
+        json.dumps({"type": "clothing", "id": 99, "asset_id": 999, "classification": "top"}),
+    ]
+    body = "\n".join(lines + malformed) + "\n"
+
+    response = client.post("/user/import/", data=body, headers=auth(app, "b"))
+    assert response.status_code == 200, response.data
+    summary = json.loads(response.data)
+    assert {key: summary[key] for key in ["assets", "clothing", "outfits", "tags", "skipped"]} == {
+        "assets": 8, "clothing": 8, "outfits": 2, "tags": 0, "skipped": 4
+    }
+    assert summary["errors"] == [
+        {"line": 20, "error": "Line is not valid JSON"},
+        {"line": 21, "error": "Line is not a JSON object"},
+        {"line": 22, "error": "Unknown type"},
+        {"line": 23, "error": "Image not found"},
+    ]
+
+    a_clothing, a_outfits = wardrobe_rows(app, "a")
+    b_clothing, b_outfits = wardrobe_rows(app, "b")
+    # new ids after every existing row, same images and classifications
+    assert [row[0] for row in b_clothing] == list(range(13, 21))
+    assert [row[1:] for row in b_clothing] == [row[1:] for row in a_clothing]
+    # the outfits point at b's copies of the clothing
+    remapped = {a_row[0]: b_row[0] for a_row, b_row in zip(a_clothing, b_clothing)}
+    assert b_outfits == [
+        (name, [remapped[clothing_id] for clothing_id in slots], labels) for name, slots, labels in a_outfits
+    ]
+    assert b_outfits[1][2] == ["red"]
+
+    with app.app_context():
+        references = dict(
+            db.session.query(Clothing.asset_id, db.func.count()).group_by(Clothing.asset_id).all()
+        )
+        assert {asset.id: asset.ref_count for asset in Asset.query} == references
+        assert db.session.execute(db.text("PRAGMA foreign_key_check")).fetchall() == []
@@ -4,8 +4,17 @@ DAO (Data Access Object) file
 Helper file containing functions for accessing data in our database
 """
 
+import assets_dao
+import passwords
 from db import db
 from db import User
+from db import Clothing
+from db import Outfit
+from db import Asset
+from db import association_table
+from db import SESSION_TOKEN
+from db import UPDATE_TOKEN
+from db import load_token
 
 
 def get_user_by_username(username):
@@ -15,29 +24,69 @@ def get_user_by_username(username):
     return User.query.filter(User.username == username).first()
 
 
+def get_token_version(user_id):
+    """
+    Returns the current token version of a user, or None if the user is
+    gone; read on every request (one primary key lookup) so a token
+    revoked on any worker stops working at once
+    """
+    return db.session.query(User.token_version).filter(User.id == user_id).scalar()
+
+
+def get_user_id_by_session_token(session_token):
+    """
+    Returns the id of the user a valid session token belongs to, or None
+
+    Checks the signature and expiry, then the token version with one
+    primary key lookup
+    """
+    payload = load_token(session_token, SESSION_TOKEN)
+    if payload is None or payload["version"] != get_token_version(payload["user_id"]):
+        return None
+    return payload["user_id"]
+
+
 def get_user_by_session_token(session_token):
     """
-    Returns a user object from the database given a session token
+    Returns a user object from the database given a valid session token
     """
-    return User.query.filter(User.session_token == session_token).first()
+    user_id = get_user_id_by_session_token(session_token)
+    if user_id is None:
+        return None
+    return User.query.filter(User.id == user_id).first()
 
 
 def get_user_by_update_token(update_token):
     """
-    Returns a user object from the database given an update token
+    Returns a user object from the database given a valid update token
     """
-    return User.query.filter(User.update_token == update_token).first()
+    payload = load_token(update_token, UPDATE_TOKEN)
+    if payload is None:
+        return None
+    user = User.query.filter(User.id == payload["user_id"]).first()
+    if user is None or not user.verify_update_token(update_token):
+        return None
+    return user
 
 
 def verify_credentials(username, password):
     """
     Returns true if the credentials match, otherwise returns false
+
+    On success, the password is rehashed if BCRYPT_ROUNDS has changed
+    and new session and update tokens are issued to the user
     """
     optional_user = get_user_by_username(username)
     if optional_user is None:
         return False, None
     
-    return optional_user.verify_password(password), optional_user
+    if not optional_user.verify_password(password):
+        return False, optional_user
+    if passwords.needs_rehash(optional_user.password_digest):
+        optional_user.password_digest = passwords.hash_password(password)
+        db.session.commit()
+    optional_user.issue_tokens()
+    return True, optional_user
 
 
 def create_user(username, password):
@@ -52,6 +101,7 @@ def create_user(username, password):
     user = User(username=username, password=password)
     db.session.add(user)
     db.session.commit()
+    user.issue_tokens()
     return True, user
 
 
@@ -67,3 +117,43 @@ def renew_session(update_token):
     user.renew_session()
     db.session.commit()
     return user
+
+
+def bump_data_version(user_id):
+    """
+    Marks a user's clothing, outfits or tags as changed, invalidating
+    their cached list responses
+
+    Does not commit; call it in the same transaction as the change
+    """
+    User.query.filter(User.id == user_id).update(
+        {"data_version": User.data_version + 1}, synchronize_session=False
+    )
+
+
+def end_session(user):
+    """
+    Logs a user out by revoking all of their session and update tokens
+    """
+    user.token_version += 1
+    db.session.commit()
+
+
+def delete_user(user):
+    """
+    Deletes a user with all of their outfits and clothing in one
+    transaction, along with the assets that only their clothing used;
+    the stored images of those assets are queued for the sweeper
+
+    Returns how many rows of each kind were deleted
+    """
+    asset_ids = assets_dao.release_user_assets(user.id)
+    outfit_ids = db.session.query(Outfit.id).filter(Outfit.user_id == user.id)
+    db.session.execute(association_table.delete().where(association_table.c.outfit_id.in_(outfit_ids)))
+    outfits = Outfit.query.filter(Outfit.user_id == user.id).delete(synchronize_session=False)
+    clothing = Clothing.query.filter(Clothing.user_id == user.id).delete(synchronize_session=False)
+    for i in range(0, len(asset_ids), 500):
+        Asset.query.filter(Asset.id.in_(asset_ids[i:i + 500])).delete(synchronize_session=False)
+    db.session.delete(user)
+    db.session.commit()
+    return {"outfits": outfits, "clothing": clothing, "assets": len(asset_ids)}
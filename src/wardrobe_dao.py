@@ -0,0 +1,411 @@
+"""
+DAO (Data Access Object) file
+
+Helper file for exporting a user's whole wardrobe and importing it back,
+as NDJSON: one JSON object per line, each with a "type"
+
+    {"type": "wardrobe", "version", "username", "exported_at"}
+    {"type": "asset", "id", "content_hash", "extension", "width", "height",
+     "palette", "url", and "image_data" when images are exported}
+    {"type": "clothing", "id", "asset_id", "classification"}
+    {"type": "outfit", "id", "name", "headwear_id", "top_id", "bottom_id",
+     "shoes_id", "tags"}
+
+The header comes first, then assets, then the clothing that uses them,
+then outfits. Ids are those of the exporting database and are remapped
+on import
+"""
+
+import base64
+import datetime
+import itertools
+import json
+import os
+
+from sqlalchemy import func
+
+import assets_dao
+import images
+import serialization
+import users_dao
+from db import db
+from db import Asset
+from db import Clothing
+from db import Outfit
+from db import Tag
+from db import association_table
+from db import ASSET_READY
+from images import InvalidImage
+from storage import get_storage
+from suggestions import decode_palette
+
+EXPORT_VERSION = 1
+# rows fetched from the database at a time, and bytes sent to the client
+# at a time, while exporting
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 500))
+EXPORT_CHUNK_BYTES = int(os.environ.get("EXPORT_CHUNK_BYTES", 64 * 1024))
+
+# rows inserted per transaction while importing; assets carrying images
+# are decoded and held in memory until their batch commits, so those
+# batches are kept smaller
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+IMPORT_IMAGE_BATCH_SIZE = int(os.environ.get("IMPORT_IMAGE_BATCH_SIZE", 16))
+IMPORT_MAX_ERRORS = 100
+# an asset line with the largest image allowed, plus its other fields
+IMPORT_MAX_LINE_BYTES = images.max_encoded_length() + 64 * 1024
+
+MIME_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "gif": "image/gif"}
+SLOTS = ["headwear", "top", "bottom", "shoes"]
+
+
+def _export_records(user, include_images):
+    """
+    Yields the records of a user's wardrobe, reading each table in
+    batches of EXPORT_BATCH_SIZE rows
+    """
+    yield {
+        "type": "wardrobe",
+        "version": EXPORT_VERSION,
+        "username": user.username,
+        "exported_at": str(datetime.datetime.now())
+    }
+    owned = db.session.query(Clothing.asset_id).filter(Clothing.user_id == user.id)
+    assets = db.session.query(
+        Asset.id, Asset.base_url, Asset.salt, Asset.extension, Asset.width, Asset.height,
+        Asset.status, Asset.content_hash, Asset.palette
+    ).filter(Asset.id.in_(owned)).order_by(Asset.id).yield_per(EXPORT_BATCH_SIZE)
+    for asset in assets:
+        key = f"{asset.salt}.{asset.extension}"
+        record = {
+            "type": "asset",
+            "id": asset.id,
+            "content_hash": asset.content_hash,
+            "extension": asset.extension,
+            "width": asset.width,
+            "height": asset.height,
+            "palette": decode_palette(asset.palette),
+            "url": f"{asset.base_url}/{key}"
+        }
+        if include_images and asset.status == ASSET_READY:
+            try:
+                img_data = get_storage().get(key)
+                record["image_data"] = (
+                    f"data:{MIME_TYPES[asset.extension]};base64,{base64.b64encode(img_data).decode('ascii')}"
+                )
+            except Exception as e:
+                print(f"Error when exporting image {key}: {e}")
+        yield record
+
+    clothing = db.session.query(Clothing.id, Clothing.asset_id, Clothing.classification).filter(
+        Clothing.user_id == user.id
+    ).order_by(Clothing.id).yield_per(EXPORT_BATCH_SIZE)
+    for row in clothing:
+        yield {"type": "clothing", "id": row.id, "asset_id": row.asset_id, "classification": row.classification}
+
+    # one row per tag of each outfit, grouped back into outfits
+    outfits = db.session.query(
+        Outfit.id, Outfit.name, Outfit.headwear_id, Outfit.top_id, Outfit.bottom_id, Outfit.shoes_id, Tag.label
+    ).outerjoin(association_table, association_table.c.outfit_id == Outfit.id).outerjoin(
+        Tag, Tag.id == association_table.c.tag_id
+    ).filter(Outfit.user_id == user.id).order_by(Outfit.id).yield_per(EXPORT_BATCH_SIZE)
+    for _, rows in itertools.groupby(outfits, key=lambda row: row.id):
+        rows = list(rows)
+        outfit = rows[0]
+        record = {"type": "outfit", "id": outfit.id, "name": outfit.name}
+        for slot in SLOTS:
+            record[f"{slot}_id"] = getattr(outfit, f"{slot}_id")
+        record["tags"] = [row.label for row in rows if row.label is not None]
+        yield record
+
+
+def export_wardrobe(user, include_images=False):
+    """
+    Yields a user's wardrobe as NDJSON bytes, in chunks of about
+    EXPORT_CHUNK_BYTES; memory use does not grow with the wardrobe, so
+    the export can be streamed straight to the client
+
+    With include_images, each asset carries its image as a base64 data
+    URI in "image_data", making the export a complete backup
+    """
+    chunk = []
+    size = 0
+    for record in _export_records(user, include_images):
+        line = serialization.dumps(record) + b"\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def _read_records(stream):
+    """
+    Yields (line number, record, error) for each non-empty line of an
+    NDJSON stream, where either the record or the error is None; lines
+    over IMPORT_MAX_LINE_BYTES are skipped without being held in memory
+    """
+    lines = iter(lambda: stream.readline(IMPORT_MAX_LINE_BYTES + 1), b"")
+    for line_number, line in enumerate(lines, 1):
+        if len(line) > IMPORT_MAX_LINE_BYTES:
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(IMPORT_MAX_LINE_BYTES + 1)
+            yield line_number, None, f"Line is longer than {IMPORT_MAX_LINE_BYTES} bytes"
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Line is not valid JSON"
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, "Line is not a JSON object"
+            continue
+        yield line_number, record, None
+
+
+def _exported_id(record, field):
+    """
+    Returns the exported id in a field of a record, or None if it is
+    missing or not an integer
+    """
+    value = record.get(field)
+    return value if isinstance(value, int) else None
+
+
+class WardrobeImport:
+    """
+    One import into a user's wardrobe: the ids given to imported rows,
+    keyed by their exported ids, the references held on assets until the
+    import ends, and what was imported or skipped
+    """
+
+    def __init__(self, user_id):
+        """
+        Initializes an import that has not imported anything yet
+        """
+        self.user_id = user_id
+        self.asset_ids = {}
+        self.clothing_ids = {}
+        self.held = {}
+        self.counts = {"assets": 0, "clothing": 0, "outfits": 0, "tags": 0, "skipped": 0}
+        self.errors = []
+
+    def skip(self, line_number, message):
+        """
+        Records a line that was not imported, keeping the first
+        IMPORT_MAX_ERRORS reasons
+        """
+        self.counts["skipped"] += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"line": line_number, "error": message})
+
+    def add(self, kind, batch):
+        """
+        Imports a batch of (line number, record) pairs of one type
+        """
+        if kind == "asset":
+            self.add_assets(batch)
+        elif kind == "clothing":
+            self.add_clothing(batch)
+        elif kind == "outfit":
+            self.add_outfits(batch)
+
+    def add_assets(self, batch):
+        """
+        Maps exported assets to the stored assets with the same content
+        hash, and creates assets from the image_data of the others
+
+        Every asset mapped holds one reference for the import, so that
+        it is not deleted before the clothing using it is imported
+        """
+        hashes = {record.get("content_hash") for _, record in batch}
+        stored = dict(
+            db.session.query(Asset.content_hash, Asset.id).filter(
+                Asset.content_hash.in_([h for h in hashes if isinstance(h, str)])
+            )
+        )
+        mapped = {}
+        references = {}
+        to_decode = []
+        for line_number, record in batch:
+            exported_id = _exported_id(record, "id")
+            asset_id = stored.get(record.get("content_hash")) if isinstance(record.get("content_hash"), str) else None
+            if exported_id is None:
+                self.skip(line_number, "Missing id")
+            elif asset_id is not None:
+                mapped[exported_id] = asset_id
+                if asset_id not in self.held:
+                    references[asset_id] = 1
+            elif isinstance(record.get("image_data"), str):
+                to_decode.append((line_number, exported_id, record["image_data"]))
+            else:
+                self.skip(line_number, "Image not found")
+        assets_dao.reference_assets(references)
+
+        # add_assets adds one reference per image
+        created = assets_dao.add_assets([image_data for _, _, image_data in to_decode])
+        for (line_number, exported_id, _), asset in zip(to_decode, created):
+            if isinstance(asset, InvalidImage):
+                self.skip(line_number, str(asset))
+                continue
+            mapped[exported_id] = asset.id
+            references[asset.id] = references.get(asset.id, 0) + 1
+        db.session.commit()
+
+        for asset_id, count in references.items():
+            self.held[asset_id] = self.held.get(asset_id, 0) + count
+        self.asset_ids.update(mapped)
+        self.counts["assets"] += len(mapped)
+        for asset in set(asset for asset in created if isinstance(asset, Asset)):
+            asset.start_upload()
+
+    def _next_id(self, model):
+        """
+        Returns the id after the largest one in a model's table
+
+        Only safe once the transaction has written something: SQLite
+        then holds its write lock until the commit, so no other writer
+        can take the ids handed out from here
+        """
+        return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+    def add_clothing(self, batch):
+        """
+        Inserts a batch of clothing with one executemany, referencing
+        the assets imported before it
+        """
+        users_dao.bump_data_version(self.user_id)
+        next_id = self._next_id(Clothing)
+        rows = []
+        mapped = {}
+        references = {}
+        for line_number, record in batch:
+            asset_id = self.asset_ids.get(_exported_id(record, "asset_id"))
+            classification = record.get("classification")
+            if asset_id is None:
+                self.skip(line_number, "Image not found")
+                continue
+            if not isinstance(classification, str):
+                self.skip(line_number, "Missing classification")
+                continue
+            rows.append({"id": next_id, "asset_id": asset_id, "classification": classification, "user_id": self.user_id})
+            if _exported_id(record, "id") is not None:
+                mapped[_exported_id(record, "id")] = next_id
+            references[asset_id] = references.get(asset_id, 0) + 1
+            next_id += 1
+        if rows:
+            db.session.execute(Clothing.__table__.insert(), rows)
+        assets_dao.reference_assets(references)
+        db.session.commit()
+        self.clothing_ids.update(mapped)
+        self.counts["clothing"] += len(rows)
+
+    def add_outfits(self, batch):
+        """
+        Inserts a batch of outfits, the tags they use that do not exist
+        yet and their tag links, each with one executemany; outfits
+        named like one the user already has are skipped
+        """
+        users_dao.bump_data_version(self.user_id)
+        next_id = self._next_id(Outfit)
+        names = [record.get("name") for _, record in batch if isinstance(record.get("name"), str)]
+        taken = {
+            name for (name,) in db.session.query(Outfit.name).filter(
+                Outfit.user_id == self.user_id, Outfit.name.in_(names)
+            )
+        }
+        rows = []
+        labels = {}
+        for line_number, record in batch:
+            name = record.get("name")
+            if not isinstance(name, str):
+                self.skip(line_number, "Missing name")
+                continue
+            if name in taken:
+                self.skip(line_number, "Outfit already exists")
+                continue
+            taken.add(name)
+            row = {"id": next_id, "name": name, "user_id": self.user_id}
+            for slot in SLOTS:
+                # pieces that were not imported leave their slot empty
+                row[f"{slot}_id"] = self.clothing_ids.get(_exported_id(record, f"{slot}_id"))
+            rows.append(row)
+            tags = record.get("tags") if isinstance(record.get("tags"), list) else []
+            labels[next_id] = {label for label in tags if isinstance(label, str) and label}
+            next_id += 1
+
+        all_labels = set().union(*labels.values())
+        tag_ids = dict(db.session.query(Tag.label, Tag.id).filter(Tag.label.in_(all_labels))) if all_labels else {}
+        new_labels = sorted(all_labels - tag_ids.keys())
+        if new_labels:
+            next_tag_id = self._next_id(Tag)
+            new_tags = [{"id": next_tag_id + i, "label": label} for i, label in enumerate(new_labels)]
+            db.session.execute(Tag.__table__.insert(), new_tags)
+            tag_ids.update((tag["label"], tag["id"]) for tag in new_tags)
+        if rows:
+            db.session.execute(Outfit.__table__.insert(), rows)
+        links = [
+            {"outfit_id": outfit_id, "tag_id": tag_ids[label]}
+            for outfit_id, outfit_labels in labels.items()
+            for label in outfit_labels
+        ]
+        if links:
+            db.session.execute(association_table.insert(), links)
+        db.session.commit()
+        self.counts["outfits"] += len(rows)
+        self.counts["tags"] += len(new_labels)
+
+
+def import_wardrobe(user, stream):
+    """
+    Imports an NDJSON export from export_wardrobe into a user's
+    wardrobe, next to what is already there
+
+    The stream is read a line at a time and each table is written in
+    batches of IMPORT_BATCH_SIZE rows, one transaction per batch; assets
+    are matched to stored ones by content hash or created from their
+    image_data, and assets that end up unused are released at the end
+
+    Returns if the stream is an export, and a summary of what was
+    imported and skipped (or why the stream was rejected)
+    """
+    records = _read_records(stream)
+    _, header, _ = next(records, (None, None, None))
+    if header is None or header.get("type") != "wardrobe":
+        return False, "Not a wardrobe export"
+    if header.get("version") != EXPORT_VERSION:
+        return False, f"Unsupported export version {header.get('version')}"
+
+    wardrobe_import = WardrobeImport(user.id)
+    kind = None
+    batch = []
+    batch_images = 0
+    try:
+        for line_number, record, error in records:
+            if error is not None:
+                wardrobe_import.skip(line_number, error)
+                continue
+            record_kind = record.get("type")
+            if record_kind not in ("asset", "clothing", "outfit"):
+                wardrobe_import.skip(line_number, "Unknown type")
+                continue
+            if record_kind != kind or len(batch) >= IMPORT_BATCH_SIZE or batch_images >= IMPORT_IMAGE_BATCH_SIZE:
+                wardrobe_import.add(kind, batch)
+                kind = record_kind
+                batch = []
+                batch_images = 0
+            batch.append((line_number, record))
+            batch_images += "image_data" in record
+        wardrobe_import.add(kind, batch)
+    finally:
+        # drop the references held for the import, deleting the assets
+        # that no imported clothing ended up using
+        db.session.rollback()
+        assets_dao.release_assets(wardrobe_import.held)
+        db.session.commit()
+    return True, {**wardrobe_import.counts, "errors": wardrobe_import.errors}
@@ -0,0 +1,10 @@
+"""
+WSGI entry point
+
+Run "flask --app wsgi migrate" first, then:
+gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from app import create_app
+
+app = create_app()